@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 import configurations.importer
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'miqa.settings'
@@ -14,3 +15,30 @@ app = Celery(config_source='django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+# Number of pool processes of this worker, inherited by the forked processes
+worker_concurrency = 1
+
+
+@worker_init.connect
+def record_worker_concurrency(sender, **kwargs):
+    global worker_concurrency
+    worker_concurrency = sender.concurrency or 1
+
+
+@worker_process_init.connect
+def configure_inference_process(**kwargs):
+    # Only sent in the processes of the prefork pool; a solo worker keeps the torch defaults
+    from billiard.process import current_process
+    from django.conf import settings
+
+    from miqa.learning.nn_inference import configure_worker
+
+    configure_worker(
+        worker_concurrency,
+        getattr(current_process(), 'index', 0),
+        threads=settings.INFERENCE_THREADS,
+        interop_threads=settings.INFERENCE_INTEROP_THREADS,
+        pin=settings.INFERENCE_PIN_WORKERS,
+        device=settings.INFERENCE_DEVICE,
+    )
@@ -2,7 +2,17 @@
 from django.contrib import admin
 from guardian.admin import GuardedModelAdmin
 
-from .models import Evaluation, Experiment, Frame, Project, Scan, ScanDecision, Setting
+from .models import (
+    CachedEvaluation,
+    Evaluation,
+    EvaluationJob,
+    Experiment,
+    Frame,
+    Project,
+    Scan,
+    ScanDecision,
+    Setting,
+)
 
 
 @admin.register(Experiment)
@@ -59,3 +69,15 @@ class SettingAdmin(admin.ModelAdmin):
     list_display = ('key', 'value', 'type', 'group', 'is_type')
     list_filter = ('type', 'group', 'is_type')
     list_editable = ('type', 'group', 'is_type')
+
+
+@admin.register(CachedEvaluation)
+class CachedEvaluationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created', 'content_fingerprint', 'evaluation_model', 'model_checksum')
+    list_filter = ('created', 'evaluation_model')
+
+
+@admin.register(EvaluationJob)
+class EvaluationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created', 'project', 'total_frames', 'completed_frames', 'failed_frames')
+    list_filter = ('created', 'project')
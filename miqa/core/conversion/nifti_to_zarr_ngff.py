@@ -1,9 +1,15 @@
 __all__ = ['nifti_to_zarr_ngff', 'convert_to_store_path']
 
+import json
+import os
 from pathlib import Path
+import shutil
+import uuid
 
 from celery import shared_task
 
+from miqa.core.conversion.pyramid import pyramid_source, pyramid_source_file, pyramid_store_id
+
 
 def convert_to_store_path(nifti_file: str) -> Path:
     """Provide the Zarr store Path for a Nifti path."""
@@ -17,7 +23,7 @@ def nifti_to_zarr_ngff(nifti_file: str) -> str:
 
     The Zarr store will have the same path with '.zarr' appended.
 
-    If the store already exists, it will not be re-created.
+    If a complete store of the current nifti file already exists, it will not be re-created.
     """
     import itk
     import spatial_image_multiscale
@@ -25,8 +31,10 @@ def nifti_to_zarr_ngff(nifti_file: str) -> str:
     import zarr
 
     store_path = convert_to_store_path(nifti_file)
-    if store_path.exists():
+    if pyramid_store_id(nifti_file) is not None:
         return str(store_path)
+    # described before reading, so that a file replaced meanwhile is converted again later
+    source = pyramid_source(nifti_file)
     image = itk.imread(str(nifti_file))
     da = itk.xarray_from_image(image)
     da.name = 'image'
@@ -34,9 +42,21 @@ def nifti_to_zarr_ngff(nifti_file: str) -> str:
     scale_factors = [2, 2, 2, 2]
     multiscale = spatial_image_multiscale.to_multiscale(da, scale_factors)
 
-    store_path = Path(str(nifti_file) + '.zarr')
-    store = zarr.NestedDirectoryStore(str(nifti_file) + '.zarr')
+    # the store is written next to its final path and moved there once complete, so that
+    # readers never see a partially written store
+    store_id = uuid.uuid4().hex
+    partial_path = store_path.with_name(f'{store_path.name}.{store_id}.partial')
+    store = zarr.NestedDirectoryStore(str(partial_path))
     spatial_image_ngff.imwrite(multiscale, store)
+    with open(partial_path / pyramid_source_file, 'w') as fd:
+        json.dump({**source, 'id': store_id}, fd)
+
+    if store_path.exists():  # converted from a previous version of the nifti file
+        shutil.rmtree(store_path, ignore_errors=True)
+    try:
+        os.rename(partial_path, store_path)
+    except OSError:  # a concurrent conversion finished first
+        shutil.rmtree(partial_path, ignore_errors=True)
 
     # celery tasks must return a serializable type; using string here
     return str(store_path)
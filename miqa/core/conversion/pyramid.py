@@ -0,0 +1,32 @@
+__all__ = ['pyramid_source', 'pyramid_source_file', 'pyramid_store_id']
+
+import json
+import os
+from pathlib import Path
+
+# nifti_to_zarr_ngff writes this file into a Zarr store once the store is complete
+pyramid_source_file = 'miqa_source.json'
+
+
+def pyramid_source(image_path):
+    """Describe the image file which a Zarr pyramid is converted from."""
+    stat = os.stat(image_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def pyramid_store_id(image_path):
+    """
+    Identify the Zarr pyramid of an image, or return None if it has no usable pyramid.
+
+    A store is only usable once it is complete, and while it was converted from the current
+    version of the image. Each conversion gets a new id.
+    """
+    try:
+        with open(Path(f'{image_path}.zarr') / pyramid_source_file) as fd:
+            source = json.load(fd)
+        current = pyramid_source(image_path)
+    except (OSError, ValueError):
+        return None
+    if any(source.get(key) != value for key, value in current.items()):
+        return None
+    return source.get('id')
@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+
+import djclick as click
+
+from miqa.core.models import Frame, Project
+from miqa.learning.evaluation_models import NNModel
+from miqa.learning.nn_inference import (
+    get_model,
+    quantization_report,
+    quantize_model,
+    save_quantized_model,
+)
+
+
+# calibrate a statically quantized int8 variant of an evaluation model on a project's frames
+@click.option(
+    '--project',
+    'project_name',
+    type=click.STRING,
+    required=True,
+    help='name of the project whose frames are used for calibration',
+)
+@click.option('--samples', type=click.INT, default=32, help='number of frames to sample')
+@click.option('--report', type=click.Path(), help='path of the JSON accuracy report')
+@click.argument('model_name')
+@click.command()
+def command(model_name, project_name, samples, report):
+    project = Project.objects.get(name=project_name)
+    eval_model_nn = NNModel(project.model_mappings[model_name], [])
+    scan_types = [
+        scan_type
+        for scan_type, mapped_model_name in project.model_source_type_mappings.items()
+        if mapped_model_name == model_name
+    ]
+    frames = Frame.objects.filter(
+        scan__experiment__project=project, scan__scan_type__in=scan_types
+    ).order_by('?')
+    image_paths = []
+    for frame in frames.iterator():
+        if frame.path.is_file():
+            image_paths.append(str(frame.path))
+            if len(image_paths) == samples:
+                break
+    if len(image_paths) < 2:
+        raise click.ClickException(f'Project {project_name} has too few local {model_name} frames.')
+
+    # keep half of the sample for the accuracy report
+    calibration_paths = image_paths[: len(image_paths) // 2]
+    evaluation_paths = image_paths[len(image_paths) // 2 :]
+    float_model = get_model(str(eval_model_nn.path))
+    quantized_model = quantize_model(float_model, calibration_paths)
+    save_quantized_model(quantized_model, str(eval_model_nn.quantized_path))
+    click.echo(f'Quantized model written: {eval_model_nn.quantized_path}')
+
+    report_json = json.dumps(
+        quantization_report(float_model, quantized_model, evaluation_paths), indent=2
+    )
+    if report:
+        Path(report).write_text(report_json)
+        click.echo(f'Accuracy report written: {report}')
+    else:
+        click.echo(report_json)
@@ -0,0 +1,112 @@
+"""Durations and sizes of the stages of evaluation tasks, in the Prometheus text format."""
+
+from contextlib import contextmanager
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the duration histogram buckets, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class StageMetrics:
+    """
+    Counters and duration histograms of the stages run by this process.
+
+    Stages are recorded from worker threads as well, e.g. by parallel S3 downloads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+        self._seconds: Dict[str, float] = {}
+        self._bytes: Dict[str, int] = {}
+        self._buckets: Dict[str, List[int]] = {}
+
+    def record(self, stage: str, seconds: float, nbytes: int = 0):
+        with self._lock:
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+            self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+            buckets = self._buckets.setdefault(stage, [0] * len(BUCKETS))
+            for index, upper_bound in enumerate(BUCKETS):
+                if seconds <= upper_bound:
+                    buckets[index] += 1
+
+    @contextmanager
+    def time(self, stage: str, nbytes: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, nbytes)
+
+    def totals(self) -> Dict[str, tuple]:
+        with self._lock:
+            return {stage: (self._seconds[stage], self._bytes[stage]) for stage in self._counts}
+
+    def render(self) -> str:
+        labels = f'pid="{os.getpid()}"'
+        lines = [
+            '# HELP miqa_stage_seconds Duration of the stages of evaluation tasks.',
+            '# TYPE miqa_stage_seconds histogram',
+        ]
+        with self._lock:
+            for stage in sorted(self._counts):
+                stage_labels = f'stage="{stage}",{labels}'
+                for upper_bound, count in zip(BUCKETS, self._buckets[stage]):
+                    lines.append(
+                        f'miqa_stage_seconds_bucket{{{stage_labels},le="{upper_bound}"}} {count}'
+                    )
+                lines.append(
+                    f'miqa_stage_seconds_bucket{{{stage_labels},le="+Inf"}} {self._counts[stage]}'
+                )
+                lines.append(f'miqa_stage_seconds_sum{{{stage_labels}}} {self._seconds[stage]}')
+                lines.append(f'miqa_stage_seconds_count{{{stage_labels}}} {self._counts[stage]}')
+            lines += [
+                '# HELP miqa_stage_bytes_total Bytes processed by the stages of evaluation tasks.',
+                '# TYPE miqa_stage_bytes_total counter',
+            ]
+            for stage in sorted(self._counts):
+                lines.append(
+                    f'miqa_stage_bytes_total{{stage="{stage}",{labels}}} {self._bytes[stage]}'
+                )
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, directory: str):
+        # for the textfile collector of the Prometheus node exporter, which must never see a
+        # partially written file
+        path = Path(directory) / f'miqa-{os.getpid()}.prom'
+        partial_path = path.with_suffix('.prom.partial')
+        partial_path.write_text(self.render())
+        os.replace(partial_path, path)
+
+
+stage_metrics = StageMetrics()
+
+
+@contextmanager
+def measure_task(task_name: str):
+    """Log how long each stage of a task took, and export the metrics of this process."""
+    before = stage_metrics.totals()
+    with stage_metrics.time(task_name):
+        yield
+    stages = []
+    for stage, (seconds, nbytes) in stage_metrics.totals().items():
+        seconds -= before.get(stage, (0.0, 0))[0]
+        nbytes -= before.get(stage, (0.0, 0))[1]
+        if stage != task_name and seconds > 0:
+            size = f' ({nbytes / 2**20:.1f}MB)' if nbytes else ''
+            stages.append(f'{stage} {seconds:.2f}s{size}')
+    task_seconds = stage_metrics.totals()[task_name][0] - before.get(task_name, (0.0, 0))[0]
+    logger.info(f'{task_name} took {task_seconds:.2f}s: {", ".join(stages)}')
+
+    if settings.INFERENCE_METRICS_DIR:
+        stage_metrics.write_textfile(settings.INFERENCE_METRICS_DIR)
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.16 on 2026-10-17 00:10
+
+import uuid
+
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0036_add_setting_alter_project'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedEvaluation',
+            fields=[
+                (
+                    'created',
+                    django_extensions.db.fields.CreationDateTimeField(
+                        auto_now_add=True, verbose_name='created'
+                    ),
+                ),
+                (
+                    'modified',
+                    django_extensions.db.fields.ModificationDateTimeField(
+                        auto_now=True, verbose_name='modified'
+                    ),
+                ),
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4, editable=False, primary_key=True, serialize=False
+                    ),
+                ),
+                ('content_fingerprint', models.CharField(max_length=80)),
+                ('evaluation_model', models.CharField(max_length=50)),
+                ('model_checksum', models.CharField(max_length=64)),
+                ('results', models.JSONField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cachedevaluation',
+            constraint=models.UniqueConstraint(
+                fields=('content_fingerprint', 'evaluation_model', 'model_checksum'),
+                name='unique_cached_evaluation',
+            ),
+        ),
+    ]
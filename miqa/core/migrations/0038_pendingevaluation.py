@@ -0,0 +1,31 @@
+# Generated by Django 3.2.16 on 2026-10-17 02:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0037_cachedevaluation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingEvaluation',
+            fields=[
+                (
+                    'frame',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name='pending_evaluation',
+                        serialize=False,
+                        to='core.frame',
+                    ),
+                ),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.16 on 2026-10-17 03:55
+
+import uuid
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0038_pendingevaluation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvaluationJob',
+            fields=[
+                (
+                    'created',
+                    django_extensions.db.fields.CreationDateTimeField(
+                        auto_now_add=True, verbose_name='created'
+                    ),
+                ),
+                (
+                    'modified',
+                    django_extensions.db.fields.ModificationDateTimeField(
+                        auto_now=True, verbose_name='modified'
+                    ),
+                ),
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4, editable=False, primary_key=True, serialize=False
+                    ),
+                ),
+                ('total_frames', models.PositiveIntegerField()),
+                ('completed_frames', models.PositiveIntegerField(default=0)),
+                ('failed_frames', models.PositiveIntegerField(default=0)),
+                (
+                    'project',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='evaluation_jobs',
+                        to='core.project',
+                    ),
+                ),
+            ],
+            options={
+                'get_latest_by': 'created',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-17 05:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0039_evaluationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='early_exit_bands',
+            field=models.JSONField(
+                blank=True,
+                help_text=(
+                    'Score ranges, e.g. {"overall_quality": [0.3, 0.7], "artifacts": [0.2, 0.8]}, '
+                    'within which a half resolution evaluation is repeated at full resolution. '
+                    'If not set, scans are always evaluated at full resolution.'
+                ),
+                null=True,
+            ),
+        ),
+    ]
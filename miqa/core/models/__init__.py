@@ -1,17 +1,23 @@
+from .cached_evaluation import CachedEvaluation
 from .evaluation import Evaluation
+from .evaluation_job import EvaluationJob
 from .experiment import Experiment
 from .frame import Frame
 from .global_settings import GlobalSettings
+from .pending_evaluation import PendingEvaluation
 from .project import Project
 from .scan import Scan
 from .scan_decision import ScanDecision
 from .setting import Setting
 
 __all__ = [
+    'CachedEvaluation',
     'Evaluation',
+    'EvaluationJob',
     'Experiment',
     'Frame',
     'GlobalSettings',
+    'PendingEvaluation',
     'Project',
     'Scan',
     'ScanDecision',
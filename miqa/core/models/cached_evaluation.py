@@ -0,0 +1,32 @@
+from uuid import uuid4
+
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class CachedEvaluation(TimeStampedModel, models.Model):
+    """
+    Results of running an evaluation model on a particular file.
+
+    Unlike Evaluation, these outlive the frames they were computed for, so re-importing a
+    project does not re-run the network on files that have not changed.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_fingerprint', 'evaluation_model', 'model_checksum'],
+                name='unique_cached_evaluation',
+            )
+        ]
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    # sha256 of the file content, or of the object metadata for files that live in S3
+    content_fingerprint = models.CharField(max_length=80)
+    evaluation_model = models.CharField(max_length=50)
+    # sha256 of the model weights file
+    model_checksum = models.CharField(max_length=64)
+    results = models.JSONField()
+
+    def __str__(self):
+        return f'{self.evaluation_model} results for {self.content_fingerprint}'
@@ -0,0 +1,25 @@
+from uuid import uuid4
+
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class EvaluationJob(TimeStampedModel, models.Model):
+    """Progress of evaluating the frames of an import, which happens in chunks on many workers."""
+
+    class Meta:
+        get_latest_by = 'created'
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    project = models.ForeignKey('Project', related_name='evaluation_jobs', on_delete=models.CASCADE)
+    total_frames = models.PositiveIntegerField()
+    completed_frames = models.PositiveIntegerField(default=0)
+    # frames which were still not evaluated after all retries of their chunk
+    failed_frames = models.PositiveIntegerField(default=0)
+
+    @property
+    def done(self) -> bool:
+        return self.completed_frames + self.failed_frames >= self.total_frames
+
+    def __str__(self):
+        return f'Evaluation of {self.total_frames} frames in {self.project.name}'
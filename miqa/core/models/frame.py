@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 from enum import Enum
+from hashlib import sha256
 from pathlib import Path
 from typing import TYPE_CHECKING, Optional
 from uuid import uuid4
 
-import boto3
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
@@ -14,6 +15,7 @@ from django_extensions.db.models import TimeStampedModel
 from s3_file_field import S3FileField
 
 from miqa.core.conversion.nifti_to_zarr_ngff import convert_to_store_path
+from miqa.core.s3 import get_s3_client
 
 if TYPE_CHECKING:
     from miqa.core.models import Experiment
@@ -65,10 +67,24 @@ class Frame(TimeStampedModel, models.Model):
     def s3_download_url(self) -> Optional[str]:
         if self.storage_mode == StorageMode.S3_PATH:
             bucket, key = self.raw_path.strip()[5:].split('/', maxsplit=1)
-            client = boto3.client('s3')
-            return client.generate_presigned_url(
-                'get_object', Params={'Bucket': bucket, 'Key': key}
-            )
+            # signing is repeated for every frame of a serialized project, so reuse recent URLs
+            cache_key = 'presigned-url:' + sha256(f'{bucket}/{key}'.encode()).hexdigest()
+            url = cache.get(cache_key)
+            if url is None:
+                client = get_s3_client()
+                url = client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': bucket, 'Key': key},
+                    ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRATION,
+                )
+                # a cached URL must remain valid for a while after it is handed out, for at
+                # least a quarter of its lifetime even if the cache timeout is set too long
+                timeout = min(
+                    settings.S3_PRESIGNED_URL_CACHE_TIMEOUT,
+                    settings.S3_PRESIGNED_URL_EXPIRATION * 3 // 4,
+                )
+                cache.set(cache_key, url, timeout=timeout)
+            return url
         return None
 
 
@@ -0,0 +1,25 @@
+from django.db import models
+
+
+class PendingEvaluation(models.Model):
+    """
+    An uploaded frame which is waiting to be evaluated.
+
+    Frames uploaded in quick succession are evaluated together by evaluate_pending_frames,
+    so that the network runs on a batch of frames instead of one at a time.
+    """
+
+    frame = models.OneToOneField(
+        'Frame',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='pending_evaluation',
+    )
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # when a run of evaluate_pending_frames started to evaluate this frame
+    claimed = models.DateTimeField(null=True, blank=True)
+    # number of batches which failed to evaluate this frame
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    def __str__(self):
+        return f'Pending evaluation for {str(self.frame.raw_path)}'
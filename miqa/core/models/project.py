@@ -54,6 +54,13 @@ class Project(TimeStampedModel, models.Model):
         default=False, help_text='Whether the S3 bucket is publicly readable.'
     )
     evaluation_models = models.JSONField(default=default_evaluation_model_mapping)
+    early_exit_bands = models.JSONField(
+        null=True,
+        blank=True,
+        help_text='Score ranges, e.g. {"overall_quality": [0.3, 0.7], "artifacts": [0.2, 0.8]}, '
+        'within which a half resolution evaluation is repeated at full resolution. '
+        'If not set, scans are always evaluated at full resolution.',
+    )
     default_email_recipients = models.TextField(blank=True)
     artifacts_group = models.ForeignKey(
         'Setting',
@@ -166,6 +173,20 @@ class Project(TimeStampedModel, models.Model):
                 f'Valid evaluation model names are {available_evaluation_models}'
             )
 
+        if self.early_exit_bands is not None:
+            if not isinstance(self.early_exit_bands, dict) or any(
+                key not in ['overall_quality', 'artifacts']
+                or not isinstance(band, list)
+                or len(band) != 2
+                or not all(isinstance(bound, (int, float)) for bound in band)
+                or not 0 <= band[0] <= band[1] <= 1
+                for key, band in self.early_exit_bands.items()
+            ):
+                raise ValidationError(
+                    'Specify early exit bands as a dictionary from "overall_quality" and '
+                    '"artifacts" to [low, high] score ranges between 0 and 1.'
+                )
+
         super().clean()
 
     def get_read_permission_groups(self):
@@ -16,7 +16,7 @@ from rest_framework.viewsets import GenericViewSet
 from miqa.core.models import Evaluation, Experiment, Frame, Project, Scan
 from miqa.core.models.frame import StorageMode
 from miqa.core.rest.permissions import project_permission_required
-from miqa.core.tasks import evaluate_frame_content
+from miqa.core.tasks import queue_frame_evaluation
 
 from .permissions import UserHoldsExperimentLock
 
@@ -139,7 +139,7 @@ class FrameViewSet(
         content_serializer = FrameContentSerializer(data=dict(request.data, scan=scan.id))
         content_serializer.is_valid(raise_exception=True)
         new_frame = content_serializer.save()
-        evaluate_frame_content.delay(str(new_frame.id))
+        queue_frame_evaluation(new_frame)
         return Response(
             FrameSerializer(new_frame).data,
             status=status.HTTP_201_CREATED,
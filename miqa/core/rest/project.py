@@ -7,7 +7,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
-from miqa.core.models import Project
+from miqa.core.models import EvaluationJob, Project
 from miqa.core.rest.experiment import ExperimentSerializer
 from miqa.core.rest.permissions import project_permission_required
 from miqa.core.rest.user import UserSerializer
@@ -24,6 +24,7 @@ class ProjectSettingsSerializer(serializers.ModelSerializer):
             'default_email_recipients',
             'anatomy_orientation',
             'artifacts',
+            'early_exit_bands',
         ]
 
     permissions = serializers.SerializerMethodField('get_permissions')
@@ -106,6 +107,14 @@ class ProjectTaskOverviewSerializer(serializers.ModelSerializer):
         }
 
 
+class EvaluationJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EvaluationJob
+        fields = ['id', 'created', 'total_frames', 'completed_frames', 'failed_frames', 'done']
+
+    done = serializers.BooleanField(read_only=True)
+
+
 class ProjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Project
@@ -197,6 +206,9 @@ class ProjectViewSet(
             if 'anatomy_orientation' in request.data:
                 project.anatomy_orientation = request.data['anatomy_orientation']
 
+            if 'early_exit_bands' in request.data:
+                project.early_exit_bands = request.data['early_exit_bands']
+
             project.import_path = request.data['import_path']
             project.export_path = request.data['export_path']
             project.full_clean()
@@ -259,3 +271,16 @@ class ProjectViewSet(
             ProjectTaskOverviewSerializer(project, context={'user': request.user}).data,
             status=status.HTTP_200_OK,
         )
+
+    @swagger_auto_schema(
+        responses={200: EvaluationJobSerializer(), 204: 'No evaluation job has been started.'},
+    )
+    @project_permission_required()
+    @action(detail=True, url_path='evaluation_progress', methods=['GET'])
+    def evaluation_progress(self, request, **kwargs):
+        project: Project = self.get_object()
+        try:
+            job = project.evaluation_jobs.latest()
+        except EvaluationJob.DoesNotExist:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(EvaluationJobSerializer(job).data, status=status.HTTP_200_OK)
@@ -0,0 +1,44 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import boto3
+from botocore import UNSIGNED
+from botocore.client import BaseClient, Config
+from django.conf import settings
+
+_clients: Dict[Tuple[bool, Optional[str], Optional[str]], BaseClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # connection pools cannot be shared with a forked child, e.g. a celery prefork worker, and
+    # the lock may have been held by another thread of the parent when it forked
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_s3_client(
+    public: bool = False, region_name: Optional[str] = None, endpoint_url: Optional[str] = None
+) -> BaseClient:
+    """
+    Get the S3 client shared by this process for the given bucket access and location.
+
+    Clients are thread-safe and keep a pool of open connections, so reusing them avoids paying
+    for client construction and a TLS handshake for every object that is accessed.
+    """
+    key = (public, region_name, endpoint_url)
+    with _clients_lock:
+        if key not in _clients:
+            config = Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS)
+            if public:
+                config = config.merge(Config(signature_version=UNSIGNED))
+            # the default boto3 session is not thread-safe, so each client gets its own
+            _clients[key] = boto3.session.Session().client(
+                's3', config=config, region_name=region_name, endpoint_url=endpoint_url
+            )
+        return _clients[key]
@@ -1,17 +1,23 @@
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import hashlib
 from io import BytesIO, StringIO
+from itertools import islice
 import json
 from pathlib import Path
+import shutil
 import tempfile
-from typing import Dict, List, Optional
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from celery import shared_task
+from celery import group, shared_task
 import dateparser
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 import pandas
 from rest_framework.exceptions import APIException
 
@@ -21,35 +27,239 @@ from miqa.core.conversion.import_export_csvs import (
     validate_import_dict,
 )
 from miqa.core.conversion.nifti_to_zarr_ngff import nifti_to_zarr_ngff
+from miqa.core.conversion.pyramid import pyramid_store_id
+from miqa.core.metrics import measure_task, stage_metrics
 from miqa.core.models import (
+    CachedEvaluation,
     Evaluation,
+    EvaluationJob,
     Experiment,
     Frame,
     GlobalSettings,
+    PendingEvaluation,
     Project,
     Scan,
     ScanDecision,
 )
 from miqa.core.models.frame import StorageMode
 from miqa.core.models.scan_decision import DECISION_CHOICES
-from miqa.learning.evaluation_models import NNModel
-
-
-def _get_s3_client(public: bool):
-    if public:
-        return boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    else:
-        return boto3.client('s3')
+from miqa.core.s3 import get_s3_client
+from miqa.learning import nn_inference
+from miqa.learning.evaluation_models import NNModel, model_cache
+from miqa.learning.nn_inference import stage_listeners
+
+nn_inference.inference_device = settings.INFERENCE_DEVICE
+model_cache.configure(
+    max_models=settings.MODEL_CACHE_SIZE,
+    max_bytes=settings.MODEL_CACHE_MAX_MEGABYTES * 2**20,
+)
+# record the decode, reorient, tiling and forward stages of inference
+stage_listeners.append(stage_metrics.record)
 
 
 def _download_from_s3(path: str, public: bool) -> bytes:
     bucket, key = path.strip()[5:].split('/', maxsplit=1)
-    client = _get_s3_client(public)
+    client = get_s3_client(public)
     buf = BytesIO()
     client.download_fileobj(bucket, key, buf)
     return buf.getvalue()
 
 
+def _download_s3_to_file(path: str, public: bool, dest: Path) -> Path:
+    # download_file streams the object to disk in chunks instead of buffering it in memory
+    bucket, key = path.strip()[5:].split('/', maxsplit=1)
+    start = time.perf_counter()
+    get_s3_client(public).download_file(bucket, key, str(dest))
+    stage_metrics.record('download', time.perf_counter() - start, dest.stat().st_size)
+    return dest
+
+
+def _prefetch_s3_frames(frames: List[Frame], tmpdir: Path) -> Iterator[Tuple[Frame, Path]]:
+    """
+    Download S3 frames on a thread pool, yielding each frame as soon as its file is on disk.
+
+    At most twice as many downloads as there are threads are in flight, so the temporary
+    directory does not fill up when downloading is faster than evaluation.
+    """
+    max_workers = settings.S3_DOWNLOAD_WORKERS
+    pending: Dict[Future, Tuple[Frame, Path]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(frame: Frame):
+            # frame files frequently share a name, so name the local copy after the frame
+            dest = tmpdir / f'{frame.id}{"".join(frame.path.suffixes)}'
+            s3_public = frame.scan.experiment.project.s3_public
+            future = executor.submit(_download_s3_to_file, frame.raw_path, s3_public, dest)
+            pending[future] = frame, dest
+
+        remaining = iter(frames)
+        for frame in islice(remaining, 2 * max_workers):
+            submit(frame)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    frame, dest = pending.pop(future)
+                    if future.exception() is not None:
+                        dest.unlink(missing_ok=True)  # a partial download
+                        raise future.exception()
+                    yield frame, dest
+                    next_frame = next(remaining, None)
+                    if next_frame is not None:
+                        submit(next_frame)
+        finally:
+            # after a failed download, or if the caller stops early, no files are left behind
+            for future in pending:
+                future.cancel()
+            wait(pending)
+            for _, dest in pending.values():
+                dest.unlink(missing_ok=True)
+
+
+def _evaluate_s3_frames(model, frames: List[Frame], tmpdir: Path) -> Dict[Frame, dict]:
+    """
+    Evaluate S3 frames as their downloads complete.
+
+    Downloaded frames of the same project are evaluated in batches of INFERENCE_BATCH_SIZE.
+    """
+    results = {}
+    batches: Dict[Project, List[Tuple[Frame, Path]]] = {}
+
+    def evaluate_batch(project: Project):
+        batch = batches.pop(project)
+        results_by_path = _evaluate_files(
+            model,
+            [str(dest) for _, dest in batch],
+            project,
+            batch_size=settings.INFERENCE_BATCH_SIZE,
+        )
+        for frame, dest in batch:
+            results[frame] = results_by_path[str(dest)]
+            dest.unlink()
+
+    for frame, dest in _prefetch_s3_frames(frames, tmpdir):
+        project = frame.scan.experiment.project
+        batches.setdefault(project, []).append((frame, dest))
+        if len(batches[project]) >= settings.INFERENCE_BATCH_SIZE:
+            evaluate_batch(project)
+    for project in list(batches):
+        evaluate_batch(project)
+    return results
+
+
+def _copy_frame_content(frame: Frame, dest: Path) -> Path:
+    start = time.perf_counter()
+    with frame.content.open() as content, open(dest, 'wb') as fd:
+        shutil.copyfileobj(content, fd)
+    stage_metrics.record('download', time.perf_counter() - start, dest.stat().st_size)
+    return dest
+
+
+def _s3_fingerprint(path: str, public: bool) -> str:
+    # S3 objects are identified by their metadata, so they do not need to be downloaded
+    bucket, key = path.strip()[5:].split('/', maxsplit=1)
+    with stage_metrics.time('fingerprint'):
+        head = get_s3_client(public).head_object(Bucket=bucket, Key=key)
+    metadata = f'{head["ContentLength"]}:{head["LastModified"].isoformat()}:{head["ETag"]}'
+    return 's3:' + hashlib.sha256(metadata.encode()).hexdigest()
+
+
+def _file_fingerprint(path: Path) -> str:
+    start = time.perf_counter()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**20), b''):
+            sha256.update(chunk)
+    stage_metrics.record('fingerprint', time.perf_counter() - start, path.stat().st_size)
+    return 'sha256:' + sha256.hexdigest()
+
+
+def _frame_fingerprint(frame: Frame, file_path: Optional[Path] = None) -> str:
+    # S3 frames are identified without downloading them, other frames by their local file
+    if frame.storage_mode == StorageMode.S3_PATH:
+        return _s3_fingerprint(frame.raw_path, frame.scan.experiment.project.s3_public)
+    return _file_fingerprint(file_path)
+
+
+def _pyramid_level() -> Optional[int]:
+    # only local frames have Zarr stores, which are written when ZARR_SUPPORT is enabled
+    return settings.INFERENCE_PYRAMID_LEVEL if settings.ZARR_SUPPORT else None
+
+
+def _pyramid_store(file_path) -> Tuple[Optional[int], Optional[str]]:
+    # a local frame is read from its Zarr store only once a store of its current file is
+    # complete; the store is part of the fingerprint, since even its level 0 is resampled
+    pyramid_level = _pyramid_level()
+    if pyramid_level is None:
+        return None, None
+    store_id = pyramid_store_id(file_path)
+    if store_id is None:
+        return None, None
+    return pyramid_level, store_id
+
+
+def _variant_fingerprint(fingerprint: str, **options) -> str:
+    # reduced resolution modes give different results, so they are cached separately
+    options = {option: value for option, value in options.items() if value}
+    if not options:
+        return fingerprint
+    variant = json.dumps([fingerprint, options], sort_keys=True)
+    return 'variant:' + hashlib.sha256(variant.encode()).hexdigest()
+
+
+def _evaluate_files(model, file_paths: List[str], project: Project, **kwargs) -> Dict[str, dict]:
+    from miqa.learning.nn_inference import evaluate_coarse_to_fine, evaluate_many
+
+    if project.early_exit_bands:
+        return evaluate_coarse_to_fine(model, file_paths, project.early_exit_bands, **kwargs)
+    return evaluate_many(model, file_paths, **kwargs)
+
+
+def _get_evaluation_model(project: Project, model_name: str) -> NNModel:
+    # Get the PyTorch model file name
+    eval_model_file = project.model_mappings[model_name]
+    # Get the predictions associated with the model
+    eval_model_predictions = [
+        prediction_mapping for prediction_mapping in project.model_predictions[model_name]
+    ]
+    return NNModel(eval_model_file, eval_model_predictions)
+
+
+def _load_evaluation_model(eval_model_nn: NNModel):
+    # Loaded models are shared by all tasks that run in this worker process
+    model = eval_model_nn.load()
+    model.tile_batch_size = settings.INFERENCE_TILE_BATCH_SIZE
+    return model
+
+
+def _get_cached_results(
+    model_name: str, model_checksum: str, fingerprints: Iterable[str]
+) -> Dict[str, dict]:
+    return dict(
+        CachedEvaluation.objects.filter(
+            evaluation_model=model_name,
+            model_checksum=model_checksum,
+            content_fingerprint__in=set(fingerprints),
+        ).values_list('content_fingerprint', 'results')
+    )
+
+
+def _cache_results(model_name: str, model_checksum: str, results: Dict[str, dict]):
+    CachedEvaluation.objects.bulk_create(
+        [
+            CachedEvaluation(
+                content_fingerprint=fingerprint,
+                evaluation_model=model_name,
+                model_checksum=model_checksum,
+                results=result,
+            )
+            for fingerprint, result in results.items()
+        ],
+        # another worker may have evaluated the same file in the meantime
+        ignore_conflicts=True,
+    )
+
+
 @shared_task
 def reset_demo():
     demo_project = Project.objects.get(name='Demo Project')
@@ -61,54 +271,181 @@ def reset_demo():
 
 
 @shared_task
+@measure_task('evaluate_frame_content')
 def evaluate_frame_content(frame_id):
-    from miqa.learning.nn_inference import evaluate1
-
+    # Uploaded frames are now evaluated in batches by evaluate_pending_frames; this task is
+    # only kept so that workers still run the messages queued before the upgrade.
     frame = Frame.objects.get(id=frame_id)
+    project = frame.scan.experiment.project
     # Get the model that matches the frame's file type
-    eval_model_name = frame.scan.experiment.project.model_source_type_mappings[frame.scan.scan_type]
-    # Get the PyTorch model file name
-    eval_model_file = frame.scan.experiment.project.model_mappings[eval_model_name]
-    # Get the Predictions associated with the model
-    eval_model_predictions = [
-        prediction_mapping
-        for prediction_mapping in frame.scan.experiment.project.model_predictions[eval_model_name]
-    ]
-    eval_model_nn = NNModel(eval_model_file, eval_model_predictions)
+    eval_model_name = project.model_source_type_mappings[frame.scan.scan_type]
+    eval_model_nn = _get_evaluation_model(project, eval_model_name)
+    model_checksum = eval_model_nn.checksum
 
-    s3_public = frame.scan.experiment.project.s3_public
-    eval_model = eval_model_nn.load()
     with tempfile.TemporaryDirectory() as tmpdirname:
         # need to send a local version to NN
+        pyramid_level, pyramid_store = None, None
         if frame.storage_mode == StorageMode.LOCAL_PATH:
             dest = Path(frame.raw_path)
+            pyramid_level, pyramid_store = _pyramid_store(dest)
+        elif frame.storage_mode == StorageMode.S3_PATH:
+            dest = Path(tmpdirname, frame.path.name)
         else:
             dest = Path(tmpdirname, frame.content.name.split('/')[-1])
-            with open(dest, 'wb') as fd:
-                if frame.storage_mode == StorageMode.S3_PATH:
-                    fd.write(_download_from_s3(frame.content.url, s3_public))
-                else:
-                    fd.write(frame.content.open().read())
-        result = evaluate1(eval_model, dest)
+            _copy_frame_content(frame, dest)
 
-        Evaluation.objects.create(
-            frame=frame,
-            evaluation_model=eval_model_name,
-            results=result,
+        fingerprint = _variant_fingerprint(
+            _frame_fingerprint(frame, dest),
+            pyramid_level=pyramid_level,
+            pyramid_store=pyramid_store,
+            early_exit_bands=project.early_exit_bands,
         )
+        cached_results = _get_cached_results(eval_model_name, model_checksum, [fingerprint])
+        if fingerprint in cached_results:
+            result = cached_results[fingerprint]
+        else:
+            if frame.storage_mode == StorageMode.S3_PATH:
+                _download_s3_to_file(frame.raw_path, project.s3_public, dest)
+            model = _load_evaluation_model(eval_model_nn)
+            results = _evaluate_files(model, [str(dest)], project, pyramid_level=pyramid_level)
+            result = results[str(dest)]
+            _cache_results(eval_model_name, model_checksum, {fingerprint: result})
+
+        with stage_metrics.time('store'):
+            Evaluation.objects.create(
+                frame=frame,
+                evaluation_model=eval_model_name,
+                results=result,
+            )
+
+
+def queue_frame_evaluation(frame: Frame):
+    """
+    Evaluate an uploaded frame together with the frames uploaded shortly before or after it.
+
+    Pending frames are evaluated as one batch once EVALUATION_BATCH_WINDOW seconds have passed
+    since the first of them was queued, or as soon as EVALUATION_BATCH_SIZE frames are waiting.
+    """
+    PendingEvaluation.objects.create(frame=frame)
+    # Every upload schedules a run; runs which find the frames already claimed or evaluated by
+    # an earlier run do nothing.
+    if _unclaimed_pending_evaluations().count() >= settings.EVALUATION_BATCH_SIZE:
+        evaluate_pending_frames.delay()
+    else:
+        evaluate_pending_frames.apply_async(countdown=settings.EVALUATION_BATCH_WINDOW)
+
+
+# A frame is dropped from the pending frames after this many failed evaluations
+MAX_PENDING_EVALUATION_ATTEMPTS = 3
+# Frames claimed longer ago than this are claimed again, in case their worker died
+PENDING_EVALUATION_CLAIM_TIMEOUT = timedelta(hours=1)
+
+
+def _unclaimed_pending_evaluations():
+    return PendingEvaluation.objects.filter(
+        Q(claimed__isnull=True) | Q(claimed__lt=timezone.now() - PENDING_EVALUATION_CLAIM_TIMEOUT)
+    )
 
 
 @shared_task
-def evaluate_data(frames_by_project):
-    from miqa.learning.nn_inference import evaluate_many
+def evaluate_pending_frames():
+    # Claim a batch of frames, so that concurrent runs of this task evaluate different frames.
+    # The frames are only locked while they are claimed, not while they are evaluated.
+    with transaction.atomic():
+        frame_ids = list(
+            _unclaimed_pending_evaluations()
+            .select_for_update(skip_locked=True)
+            .order_by('created')
+            .values_list('frame_id', flat=True)[: settings.EVALUATION_BATCH_SIZE]
+        )
+        PendingEvaluation.objects.filter(frame_id__in=frame_ids).update(claimed=timezone.now())
+
+    frames_by_project = {}
+    frames = Frame.objects.filter(id__in=frame_ids).select_related('scan__experiment__project')
+    for frame in frames:
+        # one frame of a type without an evaluation model must not fail the whole batch
+        project = frame.scan.experiment.project
+        if frame.scan.scan_type in project.model_source_type_mappings:
+            frames_by_project.setdefault(str(project.id), []).append(str(frame.id))
+    unmapped_frame_ids = set(map(str, frame_ids)).difference(*frames_by_project.values())
+    PendingEvaluation.objects.filter(frame_id__in=unmapped_frame_ids).delete()
+
+    errors = []
+    # projects may map the same model name to different weights files
+    for project_id, project_frame_ids in frames_by_project.items():
+        pending = PendingEvaluation.objects.filter(frame_id__in=project_frame_ids)
+        try:
+            evaluate_data({project_id: project_frame_ids})
+        except Exception as e:
+            # the frames of a failed project are released, to be evaluated again later
+            errors.append(e)
+            pending.update(attempts=F('attempts') + 1, claimed=None)
+            pending.filter(attempts__gte=MAX_PENDING_EVALUATION_ATTEMPTS).delete()
+        else:
+            pending.delete()
 
+    # frames which did not fit in this batch, were queued while it was being evaluated, or
+    # failed to evaluate (those are retried after a delay)
+    if _unclaimed_pending_evaluations().exists():
+        if errors:
+            evaluate_pending_frames.apply_async(countdown=settings.EVALUATION_BATCH_WINDOW)
+        else:
+            evaluate_pending_frames.delay()
+    if errors:
+        raise errors[0]
+
+
+def dispatch_evaluation(project_id: str, frame_ids: List[str]) -> EvaluationJob:
+    """Evaluate the frames of a project in chunks, which run in parallel on all workers."""
+    job = EvaluationJob.objects.create(project_id=project_id, total_frames=len(frame_ids))
+    chunk_size = settings.EVALUATION_CHUNK_SIZE
+    group(
+        evaluate_chunk.s(str(job.id), project_id, frame_ids[start : start + chunk_size])
+        for start in range(0, len(frame_ids), chunk_size)
+    ).apply_async()
+    return job
+
+
+def _unevaluated_frame_ids(frame_ids: List[str]) -> List[str]:
+    return [
+        str(frame_id)
+        for frame_id in Frame.objects.filter(
+            id__in=frame_ids, frame_evaluation__isnull=True
+        ).values_list('id', flat=True)
+    ]
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def evaluate_chunk(self, job_id: str, project_id: str, frame_ids: List[str]):
+    # a retried chunk skips the frames which were evaluated before it failed
+    remaining_frame_ids = _unevaluated_frame_ids(frame_ids)
+    try:
+        evaluate_data({project_id: remaining_frame_ids})
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        # frames evaluated by earlier attempts, or before this one failed, are completed
+        failed_frames = len(_unevaluated_frame_ids(remaining_frame_ids))
+        EvaluationJob.objects.filter(id=job_id).update(
+            completed_frames=F('completed_frames') + len(frame_ids) - failed_frames,
+            failed_frames=F('failed_frames') + failed_frames,
+        )
+        raise
+    EvaluationJob.objects.filter(id=job_id).update(
+        completed_frames=F('completed_frames') + len(frame_ids)
+    )
+
+
+@shared_task
+@measure_task('evaluate_data')
+def evaluate_data(frames_by_project):
     model_to_frames_map = {}
     for project_id, frame_ids in frames_by_project.items():
         project = Project.objects.get(id=project_id)
         for frame_id in frame_ids:
             frame = Frame.objects.get(id=frame_id)
             file_path = frame.raw_path
-            if frame.storage_mode == StorageMode.S3_PATH or Path(file_path).exists():
+            if frame.storage_mode != StorageMode.LOCAL_PATH or Path(file_path).exists():
                 # Get the model that matches the frame's file type
                 eval_model_name = project.model_source_type_mappings[frame.scan.scan_type]
                 if eval_model_name not in model_to_frames_map:
@@ -118,35 +455,83 @@ def evaluate_data(frames_by_project):
     with tempfile.TemporaryDirectory() as tmpdirname:
         tmpdir = Path(tmpdirname)
         for model_name, frame_set in model_to_frames_map.items():
-            # Get the PyTorch model file name
-            eval_model_file = project.model_mappings[model_name]
-            # Get the predictions associated with the model
-            eval_model_predictions = [
-                prediction_mapping for prediction_mapping in project.model_predictions[model_name]
-            ]
-            # Load the appropriate NNModel
-            eval_model_nn = NNModel(eval_model_file, eval_model_predictions)
-            current_model = eval_model_nn.load()
-            file_paths = {frame: frame.raw_path for frame in frame_set}
-            for frame, file_path in file_paths.items():
+            eval_model_nn = _get_evaluation_model(project, model_name)
+            model_checksum = eval_model_nn.checksum
+            fingerprints = {}
+            local_files = {}
+            pyramid_levels = {}
+            for frame in frame_set:
+                pyramid_store = None
                 if frame.storage_mode == StorageMode.S3_PATH:
-                    s3_public = frame.scan.experiment.project.s3_public
-                    dest = tmpdir / frame.path.name
-                    with open(dest, 'wb') as fd:
-                        fd.write(_download_from_s3(file_path, s3_public))
-                    file_paths[frame] = dest
-            results = evaluate_many(current_model, list(file_paths.values()))
-
-            Evaluation.objects.bulk_create(
-                [
-                    Evaluation(
-                        frame=frame,
-                        evaluation_model=model_name,
-                        results=results[file_paths[frame]],
+                    fingerprint = _frame_fingerprint(frame)
+                elif frame.storage_mode == StorageMode.CONTENT_STORAGE:
+                    # uploaded frames are copied out of storage once, for both steps
+                    dest = tmpdir / f'{frame.id}{"".join(Path(frame.content.name).suffixes)}'
+                    local_files[frame] = str(_copy_frame_content(frame, dest))
+                    fingerprint = _frame_fingerprint(frame, dest)
+                else:
+                    local_files[frame] = frame.raw_path
+                    fingerprint = _frame_fingerprint(frame, frame.path)
+                    pyramid_levels[frame], pyramid_store = _pyramid_store(frame.path)
+                fingerprints[frame] = _variant_fingerprint(
+                    fingerprint,
+                    pyramid_level=pyramid_levels.get(frame),
+                    pyramid_store=pyramid_store,
+                    early_exit_bands=frame.scan.experiment.project.early_exit_bands,
+                )
+            results = _get_cached_results(model_name, model_checksum, fingerprints.values())
+
+            # only run the network on files that have not been evaluated by this model before
+            file_paths = {
+                frame: local_files.get(frame, frame.raw_path)
+                for frame in frame_set
+                if fingerprints[frame] not in results
+            }
+            if file_paths:
+                current_model = _load_evaluation_model(eval_model_nn)
+                new_results = {}
+                local_paths = {
+                    frame: file_path
+                    for frame, file_path in file_paths.items()
+                    if frame in local_files
+                }
+                # files are read the way their fingerprint says, so Zarr stores which are not
+                # complete yet are evaluated separately from their NIfTI files
+                paths_by_group = {}
+                for frame, file_path in local_paths.items():
+                    group_key = (frame.scan.experiment.project, pyramid_levels.get(frame))
+                    paths_by_group.setdefault(group_key, []).append(file_path)
+                local_results = {}
+                for (frame_project, frame_pyramid_level), group_paths in paths_by_group.items():
+                    local_results.update(
+                        _evaluate_files(
+                            current_model,
+                            group_paths,
+                            frame_project,
+                            batch_size=settings.INFERENCE_BATCH_SIZE,
+                            pyramid_level=frame_pyramid_level,
+                        )
                     )
-                    for frame in frame_set
-                ]
-            )
+                for frame, file_path in local_paths.items():
+                    new_results[fingerprints[frame]] = local_results[file_path]
+                s3_frames = [frame for frame in file_paths if frame not in local_paths]
+                s3_results = _evaluate_s3_frames(current_model, s3_frames, tmpdir)
+                for frame, result in s3_results.items():
+                    new_results[fingerprints[frame]] = result
+                _cache_results(model_name, model_checksum, new_results)
+                results.update(new_results)
+
+            with stage_metrics.time('store'):
+                Evaluation.objects.bulk_create(
+                    [
+                        Evaluation(
+                            frame=frame,
+                            evaluation_model=model_name,
+                            results=results[fingerprints[frame]],
+                        )
+                        for frame in frame_set
+                    ]
+                )
 
 
 def import_data(project_id: Optional[str]):
@@ -321,7 +706,8 @@ def perform_import(import_dict):
         if project_id not in frames_by_project:
             frames_by_project[project_id] = []
         frames_by_project[project_id].append(str(frame.id))
-    evaluate_data.delay(frames_by_project)
+    for project_id, frame_ids in frames_by_project.items():
+        dispatch_evaluation(project_id, frame_ids)
 
 
 def export_data(project_id: Optional[str]):
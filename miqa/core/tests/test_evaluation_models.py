@@ -0,0 +1,83 @@
+import os
+
+import pytest
+import torch
+
+from miqa.learning.evaluation_models import ModelCache, NNModel, model_size_in_bytes
+
+
+def test_model_cache_reuses_loaded_model():
+    cache = ModelCache(max_models=2)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return torch.nn.Linear(4, 4)
+
+    first = cache.get('a.pth', 'cpu', loader)
+    second = cache.get('a.pth', 'cpu', loader)
+    assert first is second
+    assert len(loads) == 1
+
+    cache.get('a.pth', 'cuda', loader)
+    cache.get('a.pth', 'cpu', loader, variant='onnx')
+    assert len(loads) == 3
+
+
+def test_model_cache_evicts_least_recently_used():
+    cache = ModelCache(max_models=2)
+    cache.get('a.pth', 'cpu', lambda: torch.nn.Linear(4, 4))
+    cache.get('b.pth', 'cpu', lambda: torch.nn.Linear(4, 4))
+    cache.get('a.pth', 'cpu', lambda: torch.nn.Linear(4, 4))
+    cache.get('c.pth', 'cpu', lambda: torch.nn.Linear(4, 4))
+    assert ('a.pth', 'cpu', 'eager') in cache
+    assert ('b.pth', 'cpu', 'eager') not in cache
+    assert ('c.pth', 'cpu', 'eager') in cache
+
+
+def test_model_cache_memory_cap():
+    model_bytes = model_size_in_bytes(torch.nn.Linear(4, 4))
+    cache = ModelCache(max_models=10, max_bytes=2 * model_bytes)
+    for name in ['a.pth', 'b.pth', 'c.pth']:
+        cache.get(name, 'cpu', lambda: torch.nn.Linear(4, 4))
+    assert len(cache) == 2
+    assert cache.total_bytes <= 2 * model_bytes
+
+
+def test_nn_model_checksum_depends_on_variant(mocker, tmp_path):
+    weights_path = tmp_path / 'miqaT1-val0.pth'
+    weights_path.write_bytes(b'weights')
+    weights_path.with_suffix('.int8.pt').write_bytes(b'int8 weights')
+    mocker.patch.object(
+        NNModel, 'path', new_callable=mocker.PropertyMock, return_value=weights_path
+    )
+
+    checksums = {
+        uri: NNModel(uri, []).checksum
+        for uri in [
+            'miqaT1-val0.pth',
+            'miqaT1-val0.pth?backend=onnx',
+            'miqaT1-val0.pth?quantization=dynamic',
+            'miqaT1-val0.pth?quantization=static',
+        ]
+    }
+    assert len(set(checksums.values())) == len(checksums)
+
+    # recalibrating replaces the int8 model in place
+    quantized_path = weights_path.with_suffix('.int8.pt')
+    quantized_path.write_bytes(b'recalibrated int8 weights')
+    os.utime(quantized_path, (0, 1))
+    static_model = NNModel('miqaT1-val0.pth?quantization=static', [])
+    assert static_model.checksum != checksums['miqaT1-val0.pth?quantization=static']
+    assert NNModel('miqaT1-val0.pth', []).checksum == checksums['miqaT1-val0.pth']
+
+
+def test_uncalibrated_static_model_explains_how_to_calibrate(mocker, tmp_path):
+    weights_path = tmp_path / 'miqaT1-val0.pth'
+    weights_path.write_bytes(b'weights')
+    mocker.patch.object(
+        NNModel, 'path', new_callable=mocker.PropertyMock, return_value=weights_path
+    )
+
+    with pytest.raises(FileNotFoundError, match='manage.py quantize_model'):
+        NNModel('miqaT1-val0.pth?quantization=static', []).checksum
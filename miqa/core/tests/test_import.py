@@ -7,7 +7,7 @@ import pytest
 from rest_framework.exceptions import APIException
 
 from miqa.core.conversion.import_export_csvs import IMPORT_CSV_COLUMNS
-from miqa.core.models import Frame, GlobalSettings
+from miqa.core.models import CachedEvaluation, Evaluation, Frame, GlobalSettings
 from miqa.core.tasks import import_data
 from miqa.core.tests.helpers import generate_import_csv, generate_import_json
 
@@ -227,6 +227,36 @@ def test_import_with_relative_path(project_factory):
     assert frame and frame.raw_path == str(Path(__file__).parent / 'data' / 'example.nii.gz')
 
 
+@pytest.mark.django_db
+def test_reimport_reuses_cached_evaluations(project_factory):
+    rel_import_csv = Path(__file__).parent / 'data' / 'relative_import.csv'
+    project = project_factory(name='Guys', import_path=rel_import_csv)
+    import_data(project.id)
+    cached_evaluation = CachedEvaluation.objects.get()
+    cached_evaluation.results = {'overall_quality': 0.5}
+    cached_evaluation.save()
+
+    import_data(project.id)
+    assert CachedEvaluation.objects.count() == 1
+    assert Evaluation.objects.get().results == {'overall_quality': 0.5}
+
+
+@pytest.mark.django_db
+def test_import_reports_evaluation_progress(project_factory, user_api_client):
+    rel_import_csv = Path(__file__).parent / 'data' / 'relative_import.csv'
+    project = project_factory(name='Guys', import_path=rel_import_csv)
+    user_api_client = user_api_client(project=project)
+    resp = user_api_client.get(f'/api/v1/projects/{project.id}/evaluation_progress')
+    assert resp.status_code == 204
+
+    import_data(project.id)
+    resp = user_api_client.get(f'/api/v1/projects/{project.id}/evaluation_progress')
+    assert resp.status_code == 200
+    assert resp.data['total_frames'] == Frame.objects.count()
+    assert resp.data['completed_frames'] == resp.data['total_frames']
+    assert resp.data['done']
+
+
 @pytest.mark.django_db
 def test_import_s3_preserves_path(project_factory):
     s3_import_csv = Path(__file__).parent / 'data' / 's3_import.csv'
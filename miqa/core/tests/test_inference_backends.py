@@ -0,0 +1,36 @@
+import torch
+
+from miqa.learning.inference_backends import backends, check_parity, use_backend
+from miqa.learning.nn_inference import artifacts, get_model, regression_count
+
+
+def test_torchscript_backend_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    model = get_model(tile_batch_size=4).cpu()
+
+    use_backend(model, 'torchscript', 'checksum', export_dir=tmp_path)
+
+    assert (tmp_path / 'checksum.torchscript.pt').exists()
+    assert model.tile_runner is not None
+    inputs = torch.rand(2, 1, 80, 70, 90)
+    with torch.no_grad():
+        actual = model(inputs)
+        tile_runner, model.tile_runner = model.tile_runner, None
+        expected = model(inputs)
+    assert torch.allclose(actual, expected, atol=1e-4)
+    assert check_parity(model, tile_runner)
+
+
+def test_mismatching_backend_falls_back_to_eager(mocker, tmp_path):
+    torch.manual_seed(0)
+    model = get_model().cpu()
+
+    def wrong_runner(tiles):
+        return torch.full((len(tiles), regression_count + len(artifacts)), 0.5)
+
+    mocker.patch.object(backends['torchscript'], 'load', return_value=wrong_runner)
+
+    use_backend(model, 'torchscript', 'checksum', export_dir=tmp_path)
+
+    assert model.tile_runner is None
+    assert not check_parity(model, wrong_runner)
@@ -0,0 +1,22 @@
+from miqa.core.metrics import StageMetrics, measure_task, stage_metrics
+
+
+def test_stage_metrics_render():
+    metrics = StageMetrics()
+    metrics.record('decode', 0.2, 1024)
+    metrics.record('decode', 2.0, 1024)
+    rendered = metrics.render()
+    assert 'miqa_stage_seconds_bucket{stage="decode",' in rendered
+    assert 'le="0.5"} 1\n' in rendered
+    assert 'le="+Inf"} 2\n' in rendered
+    assert 'miqa_stage_seconds_sum{stage="decode",' in rendered
+    assert 'miqa_stage_bytes_total{stage="decode",' in rendered and '} 2048\n' in rendered
+
+
+def test_measure_task_writes_textfile(settings, tmp_path):
+    settings.INFERENCE_METRICS_DIR = str(tmp_path)
+    with measure_task('evaluate_test'):
+        stage_metrics.record('forward', 0.1)
+    (textfile,) = tmp_path.glob('*.prom')
+    assert 'stage="evaluate_test"' in textfile.read_text()
+    assert 'stage="forward"' in textfile.read_text()
@@ -0,0 +1,291 @@
+import gzip
+import itertools
+import math
+import shutil
+import tempfile
+
+import nibabel
+import numpy as np
+import pytest
+from sklearn.metrics import confusion_matrix, mean_squared_error, r2_score
+import torch
+from torch.utils.data import DataLoader
+import torchio
+
+from miqa.learning import nn_inference
+from miqa.learning.nn_inference import (
+    ReorientAndRescale,
+    artifacts,
+    count_artifact_confusions,
+    evaluate1,
+    evaluate_coarse_to_fine,
+    evaluate_many,
+    evaluate_model,
+    get_model,
+    read_memory_mapped,
+    regression_count,
+    reorient_to_lps,
+    reorient_with_itk,
+)
+
+
+def per_tile_forward(model, inputs):
+    # the original forward pass, which ran the network on one tile at a time
+    results = []
+    z_tile_size, y_tile_size, x_tile_size = model.in_shape[:3]
+    z_size, y_size, x_size = inputs.shape[2:]
+    z_steps = math.ceil(z_size / z_tile_size)
+    y_steps = math.ceil(y_size / y_tile_size)
+    x_steps = math.ceil(x_size / x_tile_size)
+    for k in range(z_steps):
+        k_start = round(k * (z_size - z_tile_size) / max(1, z_steps - 1))
+        for j in range(y_steps):
+            j_start = round(j * (y_size - y_tile_size) / max(1, y_steps - 1))
+            for i in range(x_steps):
+                i_start = round(i * (x_size - x_tile_size) / max(1, x_steps - 1))
+                tile = inputs[
+                    :,
+                    :,
+                    k_start : k_start + z_tile_size,
+                    j_start : j_start + y_tile_size,
+                    i_start : i_start + x_tile_size,
+                ]
+                x_pad = max(0, x_tile_size - x_size)
+                y_pad = max(0, y_tile_size - y_size)
+                z_pad = max(0, z_tile_size - z_size)
+                if x_pad + y_pad + z_pad > 0:
+                    tile = torch.nn.functional.pad(
+                        tile, (0, x_pad, 0, y_pad, 0, z_pad), 'replicate'
+                    )
+                results.append(model.forward_tiles(tile))
+    return torch.mean(torch.stack(results), dim=0)
+
+
+@pytest.mark.parametrize(
+    'shape',
+    [
+        (1, 1, 40, 50, 30),  # smaller than a tile, so the tile is padded
+        (2, 1, 100, 70, 130),  # 12 overlapping tiles for each of two images
+    ],
+)
+@pytest.mark.parametrize('tile_batch_size', [1, 5, None, 0])
+def test_tile_batches_match_per_tile_forward(shape, tile_batch_size):
+    torch.manual_seed(0)
+    model = get_model(tile_batch_size=tile_batch_size).cpu().eval()
+    inputs = torch.rand(shape)
+
+    with torch.no_grad():
+        expected = per_tile_forward(model, inputs)
+        actual = model(inputs)
+
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+class StubModel(torch.nn.Module):
+    """Scores images by their size, and records the sizes it was run on."""
+
+    def __init__(self, quality_by_size):
+        super().__init__()
+        self.quality_by_size = quality_by_size
+        self.sizes = []
+
+    def forward(self, inputs):
+        size = inputs.shape[2]
+        self.sizes.extend([size] * len(inputs))
+        outputs = torch.zeros(len(inputs), regression_count + len(artifacts))
+        outputs[:, 0] = self.quality_by_size[size] * 10
+        return outputs
+
+
+def test_coarse_to_fine_refines_only_uncertain_images(tmp_path):
+    paths = {}
+    for size in [8, 10]:
+        paths[size] = str(tmp_path / f'{size}.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(np.random.rand(size, size, size), np.eye(4)), paths[size])
+    # the half resolution of the 8^3 image is uncertain, that of the 10^3 image is not
+    model = StubModel({4: 0.5, 8: 0.9, 5: 0.1, 10: 0.6})
+    bands = {'overall_quality': [0.3, 0.7], 'artifacts': [0.2, 0.8]}
+
+    results = evaluate_coarse_to_fine(model, list(paths.values()), bands)
+
+    assert sorted(model.sizes) == [4, 5, 8]
+    assert results[paths[8]]['overall_quality'] == pytest.approx(0.9)
+    assert results[paths[10]]['overall_quality'] == pytest.approx(0.1)
+
+
+def write_nifti(path, image_class, shape, byte_order, scaled):
+    data = np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+    image = image_class(data, np.diag([2.0, 3.0, 4.0, 1.0]))
+    image.header.set_data_dtype(np.int16)
+    header = image.header.as_byteswapped(byte_order)
+    nii_path = path.with_suffix('.nii') if path.suffix == '.gz' else path
+    nibabel.save(image_class(data, image.affine, header), nii_path)
+    if scaled:
+        header = nibabel.load(nii_path).header.copy()
+        header['scl_slope'] = 2.0
+        header['scl_inter'] = 10.0
+        with open(nii_path, 'r+b') as fd:
+            header.write_to(fd)
+    if nii_path != path:
+        with open(nii_path, 'rb') as src, gzip.open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+
+@pytest.mark.parametrize('suffix', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('image_class', [nibabel.Nifti1Image, nibabel.Nifti2Image])
+@pytest.mark.parametrize('shape', [(5, 6, 7), (5, 6, 7, 3)])
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+@pytest.mark.parametrize('scaled', [False, True])
+def test_read_memory_mapped_matches_nibabel(
+    tmp_path, suffix, image_class, shape, byte_order, scaled
+):
+    path = tmp_path / f'image{suffix}'
+    write_nifti(path, image_class, shape, byte_order, scaled)
+    expected = nibabel.load(path)
+
+    data, affine = read_memory_mapped(path)
+
+    # only the first volume of a series is read
+    expected_data = expected.get_fdata()[..., 0] if len(shape) > 3 else expected.get_fdata()
+    assert data.shape == (1, *shape[:3])
+    np.testing.assert_allclose(data[0].numpy(), expected_data)
+    np.testing.assert_allclose(affine, expected.affine)
+
+
+def test_read_memory_mapped_removes_temporary_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    path = tmp_path / 'corrupt.nii.gz'
+    path.write_bytes(gzip.compress(b'not a nifti file' * 40))
+
+    with pytest.raises(nibabel.spatialimages.HeaderDataError):
+        read_memory_mapped(path)
+
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def image_with_direction(direction):
+    # direction is the ITK (LPS) direction matrix, the affine is in RAS
+    affine = np.eye(4)
+    affine[:3, :3] = np.diag([-1, -1, 1]) @ direction @ np.diag([1.0, 2.0, 3.0])
+    affine[:3, 3] = [10.0, -20.0, 30.0]
+    return torchio.ScalarImage(tensor=torch.rand(1, 4, 5, 6), affine=affine)
+
+
+axis_aligned_directions = [
+    np.eye(3)[list(permutation)] * np.array(signs)[:, np.newaxis]
+    for permutation in itertools.permutations(range(3))
+    for signs in itertools.product([1, -1], repeat=3)
+]
+
+
+@pytest.mark.parametrize('direction', axis_aligned_directions)
+def test_reorient_to_lps_matches_itk(direction):
+    image = image_with_direction(direction)
+
+    expected = reorient_with_itk(image)
+    actual = reorient_to_lps(image)
+
+    assert torch.equal(actual.data, expected.data)
+    np.testing.assert_allclose(actual.affine, expected.affine, atol=1e-6)
+
+
+def test_oblique_images_are_reoriented_by_itk(mocker):
+    angle = np.radians(30)
+    rotation = np.array(
+        [
+            [np.cos(angle), -np.sin(angle), 0],
+            [np.sin(angle), np.cos(angle), 0],
+            [0, 0, 1],
+        ]
+    )
+    image = image_with_direction(rotation)
+    assert reorient_to_lps(image) is None
+
+    itk_path = mocker.patch.object(nn_inference, 'reorient_with_itk', wraps=reorient_with_itk)
+    ReorientAndRescale(out_min_max=(0, 1))(torchio.Subject(img=image))
+    itk_path.assert_called_once()
+
+
+def test_batched_results_are_keyed_by_their_image(tmp_path):
+    torch.manual_seed(0)
+    model = get_model().cpu()
+    rng = np.random.default_rng(0)
+    shapes = [(20, 20, 20), (24, 20, 16), (20, 20, 20), (30, 26, 22), (24, 20, 16), (20, 20, 20)]
+    paths = []
+    for index, shape in enumerate(shapes):
+        path = str(tmp_path / f'{index}.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(rng.random(shape), np.eye(4)), path)
+        paths.append(path)
+    rng.shuffle(paths)
+
+    # batches group images of the same shape, so they are evaluated out of order
+    results = evaluate_many(model, paths, batch_size=2)
+
+    assert sorted(results) == sorted(paths)
+    for path in paths:
+        expected = evaluate1(model, path)
+        assert results[path] == pytest.approx(expected, abs=1e-5)
+
+
+def synthetic_results(count=50):
+    rng = np.random.default_rng(0)
+    result_size = regression_count + len(artifacts)
+    outputs = rng.uniform(-0.5, 1.5, (count, result_size))
+    outputs[:, 0] = rng.uniform(-1, 11, count)
+    # artifact ground truth of -1 is missing
+    targets = rng.integers(-1, 2, (count, result_size)).astype(float)
+    targets[:, 0] = rng.integers(0, 11, count)
+    return outputs, targets
+
+
+def test_artifact_confusions_match_sklearn():
+    outputs, targets = synthetic_results()
+
+    counts = count_artifact_confusions(targets, outputs)
+
+    for index in range(len(artifacts)):
+        y_true = targets[:, regression_count + index]
+        y_out = np.clip(np.rint(outputs[:, regression_count + index]), 0, 1)
+        provided = y_true != -1
+        expected = confusion_matrix(y_true[provided], y_out[provided], labels=[0, 1])
+        assert list(counts[index]) == list(expected.flat)
+
+
+class IndexedModel(torch.nn.Module):
+    """Returns the preset outputs of the images, which hold their index."""
+
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = torch.from_numpy(outputs)
+
+    def forward(self, inputs):
+        return self.outputs[inputs.flatten(1)[:, 0].long()]
+
+
+def test_evaluate_model_metrics_match_sklearn(mocker):
+    mocker.patch.object(nn_inference, 'wandb')
+    writer = mocker.Mock()
+    outputs, targets = synthetic_results()
+    dataset = [
+        {'img': {torchio.DATA: torch.full((1, 1, 1, 1), index)}, 'info': torch.from_numpy(target)}
+        for index, target in enumerate(targets)
+    ]
+    batch_counts = []
+
+    def count_batch(batch_targets, batch_outputs):
+        batch_counts.append(count_artifact_confusions(batch_targets, batch_outputs))
+        return batch_counts[-1]
+
+    mocker.patch.object(nn_inference, 'count_artifact_confusions', side_effect=count_batch)
+
+    r2 = evaluate_model(
+        IndexedModel(outputs), DataLoader(dataset, batch_size=8), 'cpu', writer, 0, 'test'
+    )
+
+    rmse = writer.add_scalar.call_args_list[0].args[1]
+    assert rmse == pytest.approx(np.sqrt(mean_squared_error(targets[:, 0], outputs[:, 0])))
+    assert r2 == pytest.approx(r2_score(targets[:, 0], outputs[:, 0]))
+    # the counts of all batches add up to those of the whole set
+    assert len(batch_counts) == 7
+    assert np.array_equal(sum(batch_counts), count_artifact_confusions(targets, outputs))
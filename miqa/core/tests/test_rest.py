@@ -1,6 +1,7 @@
 import json
 from uuid import UUID
 
+from django.core.exceptions import ValidationError
 from guardian.shortcuts import assign_perm, get_perms
 import pytest
 
@@ -151,6 +152,7 @@ def test_project_settings_put(user_api_client, project_factory, user_factory, us
                 'swap_wraparound',
                 'truncation_artifact',
             ],
+            'early_exit_bands': None,
         }
         my_new_perms = get_perms(user, project)
         if 'collaborator' in my_perms:
@@ -159,6 +161,16 @@ def test_project_settings_put(user_api_client, project_factory, user_factory, us
             assert has_review_perm(my_new_perms)
 
 
+@pytest.mark.django_db
+def test_project_early_exit_bands_validation(project):
+    project.early_exit_bands = {'overall_quality': [0.3, 0.7], 'artifacts': [0.2, 0.8]}
+    project.full_clean()
+    for invalid_bands in [[0.3, 0.7], {'quality': [0.3, 0.7]}, {'artifacts': [0.8, 0.2]}]:
+        project.early_exit_bands = invalid_bands
+        with pytest.raises(ValidationError):
+            project.full_clean()
+
+
 @pytest.mark.django_db
 def test_settings_endpoint_requires_superuser(user_api_client, project_factory, user_factory, user):
     creator = user_factory()
@@ -0,0 +1,37 @@
+from celery import current_app
+import pytest
+
+from miqa.core import tasks
+from miqa.core.conversion.nifti_to_zarr_ngff import nifti_to_zarr_ngff
+
+
+@pytest.mark.parametrize(
+    'task,queue,priority',
+    [
+        (tasks.evaluate_frame_content, 'inference', 9),
+        (tasks.evaluate_pending_frames, 'inference', 9),
+        (tasks.evaluate_chunk, 'inference', 3),
+        (tasks.evaluate_data, 'inference', 3),
+        (nifti_to_zarr_ngff, 'conversion', None),
+        (tasks.perform_import, 'io', None),
+        (tasks.perform_export, 'io', None),
+        (tasks.reset_demo, 'celery', None),
+    ],
+)
+def test_task_routes(task, queue, priority):
+    route = current_app.amqp.router.route({}, task.name)
+    assert route['queue'].name == queue
+    assert route.get('priority') == priority
+
+
+def test_routes_name_registered_tasks(settings):
+    # a renamed task would silently fall back to the default queue
+    for task_name in settings.CELERY_TASK_ROUTES:
+        assert task_name in current_app.tasks
+
+
+def test_worker_consumes_all_queues(settings):
+    # a worker started without -Q must not leave any routed task unconsumed
+    queue_names = {queue.name for queue in current_app.amqp.queues.values()}
+    for route in settings.CELERY_TASK_ROUTES.values():
+        assert route['queue'] in queue_names
@@ -0,0 +1,57 @@
+import threading
+
+from django.core.cache import cache
+import pytest
+
+from miqa.core import s3
+from miqa.core.s3 import get_s3_client
+
+
+def test_s3_clients_are_shared():
+    assert get_s3_client() is get_s3_client()
+    assert get_s3_client(public=True) is get_s3_client(public=True)
+    assert get_s3_client(public=True) is not get_s3_client()
+    assert get_s3_client(region_name='us-west-2') is not get_s3_client()
+
+
+def test_fork_resets_s3_clients():
+    client = get_s3_client()
+    # another thread of the parent process held the lock when it forked
+    s3._clients_lock.acquire()
+    try:
+        s3._reset_after_fork()
+        assert not s3._clients_lock.locked()
+        assert get_s3_client() is not client
+    finally:
+        s3._clients_lock = threading.Lock()
+
+
+@pytest.mark.django_db
+def test_presigned_urls_are_cached(mocker, frame_factory):
+    client = mocker.Mock()
+    client.generate_presigned_url.side_effect = ['https://first', 'https://second']
+    mocker.patch('miqa.core.models.frame.get_s3_client', return_value=client)
+    cache.clear()
+
+    frame = frame_factory(raw_path='s3://miqa-sample/IXI_small/image.nii.gz')
+    assert frame.s3_download_url == 'https://first'
+    assert frame.s3_download_url == 'https://first'
+    client.generate_presigned_url.assert_called_once()
+
+    cache.clear()
+    assert frame.s3_download_url == 'https://second'
+
+
+@pytest.mark.django_db
+def test_presigned_urls_are_cached_within_their_lifetime(mocker, settings, frame_factory):
+    settings.S3_PRESIGNED_URL_EXPIRATION = 600
+    settings.S3_PRESIGNED_URL_CACHE_TIMEOUT = 3600
+    client = mocker.Mock()
+    client.generate_presigned_url.return_value = 'https://first'
+    mocker.patch('miqa.core.models.frame.get_s3_client', return_value=client)
+    cache_set = mocker.patch('miqa.core.models.frame.cache.set')
+    cache.clear()
+
+    frame = frame_factory(raw_path='s3://miqa-sample/IXI_small/image.nii.gz')
+    assert frame.s3_download_url == 'https://first'
+    assert cache_set.call_args.kwargs['timeout'] == 450
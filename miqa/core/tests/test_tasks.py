@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+
+from miqa.core.models import Evaluation, EvaluationJob, PendingEvaluation, Project
+from miqa.core.tasks import _prefetch_s3_frames, evaluate_chunk, evaluate_pending_frames
+
+
+@pytest.mark.django_db
+def test_pending_frames_are_evaluated_in_batches(mocker, settings, scan_factory, frame_factory):
+    settings.EVALUATION_BATCH_SIZE = 2
+    evaluate_data = mocker.patch('miqa.core.tasks.evaluate_data')
+    mocker.patch.object(
+        Project,
+        'model_source_type_mappings',
+        new_callable=mocker.PropertyMock,
+        return_value={'T1': 'MIQAT1-0'},
+    )
+    scan = scan_factory(scan_type='T1')
+    frames = [frame_factory(scan=scan) for _ in range(3)]
+    unmapped_frame = frame_factory()
+    for frame in [*frames, unmapped_frame]:
+        PendingEvaluation.objects.create(frame=frame)
+
+    evaluate_pending_frames()
+
+    project_id = str(scan.experiment.project.id)
+    batches = [call.args[0][project_id] for call in evaluate_data.call_args_list]
+    assert sorted(len(batch) for batch in batches) == [1, 2]
+    assert sorted(frame_id for batch in batches for frame_id in batch) == sorted(
+        str(frame.id) for frame in frames
+    )
+    assert not PendingEvaluation.objects.exists()
+
+
+@pytest.mark.django_db
+def test_failed_pending_frames_are_retried(mocker, settings, scan_factory, frame_factory):
+    settings.EVALUATION_BATCH_SIZE = 2
+    mocker.patch.object(
+        Project,
+        'model_source_type_mappings',
+        new_callable=mocker.PropertyMock,
+        return_value={'T1': 'MIQAT1-0'},
+    )
+    failed_frame = frame_factory(scan=scan_factory(scan_type='T1'))
+    frame = frame_factory(scan=scan_factory(scan_type='T1'))
+    failed_project_id = str(failed_frame.scan.experiment.project.id)
+
+    def evaluate_data(frames_by_project):
+        if failed_project_id in frames_by_project:
+            raise RuntimeError('evaluation failed')
+
+    mocker.patch('miqa.core.tasks.evaluate_data', side_effect=evaluate_data)
+    retry = mocker.patch('miqa.core.tasks.evaluate_pending_frames.apply_async')
+    for pending_frame in [failed_frame, frame]:
+        PendingEvaluation.objects.create(frame=pending_frame)
+
+    with pytest.raises(RuntimeError):
+        evaluate_pending_frames()
+
+    # only the frame of the failed project is kept, and evaluated again later
+    pending = PendingEvaluation.objects.get()
+    assert pending.frame == failed_frame
+    assert pending.attempts == 1
+    assert pending.claimed is None
+    retry.assert_called_once_with(countdown=settings.EVALUATION_BATCH_WINDOW)
+
+
+@pytest.mark.django_db
+def test_failed_chunk_counts_only_unevaluated_frames(mocker, project, scan_factory, frame_factory):
+    frames = [frame_factory(scan=scan_factory(experiment__project=project)) for _ in range(3)]
+    frame_ids = [str(frame.id) for frame in frames]
+    job = EvaluationJob.objects.create(project=project, total_frames=len(frames))
+
+    def evaluate_data(frames_by_project):
+        # the first frame is evaluated before the chunk fails
+        Evaluation.objects.create(frame=frames[0], evaluation_model='MIQAT1-0', results={})
+        raise RuntimeError('evaluation failed')
+
+    mocker.patch('miqa.core.tasks.evaluate_data', side_effect=evaluate_data)
+    mocker.patch.object(evaluate_chunk, 'max_retries', 0)
+
+    with pytest.raises(RuntimeError):
+        evaluate_chunk(str(job.id), str(project.id), frame_ids)
+
+    job.refresh_from_db()
+    assert job.completed_frames == 1
+    assert job.failed_frames == 2
+    assert job.done
+
+
+@pytest.mark.django_db
+def test_prefetch_caps_downloads_in_flight(mocker, settings, tmp_path, frame_factory):
+    settings.S3_DOWNLOAD_WORKERS = 2
+    frames = [frame_factory(raw_path=f's3://bucket/{index}.nii.gz') for index in range(10)]
+    started = []
+    lock = threading.Lock()
+
+    def download(path, public, dest):
+        with lock:
+            started.append(path)
+        dest.write_bytes(b'image')
+        return dest
+
+    mocker.patch('miqa.core.tasks._download_s3_to_file', side_effect=download)
+
+    prefetched = _prefetch_s3_frames(frames, tmp_path)
+    next(prefetched)
+    time.sleep(0.5)  # the downloads which were submitted have all started
+    # only two downloads per thread are started ahead of the consumer
+    assert len(started) == 4
+    assert len(list(prefetched)) == 9
+    assert len(started) == 10
+
+
+@pytest.mark.django_db
+def test_prefetch_removes_files_after_failed_download(mocker, settings, tmp_path, frame_factory):
+    settings.S3_DOWNLOAD_WORKERS = 2
+    frames = [frame_factory(raw_path=f's3://bucket/{index}.nii.gz') for index in range(6)]
+
+    def download(path, public, dest):
+        dest.write_bytes(b'partial')
+        if path == 's3://bucket/3.nii.gz':
+            raise OSError('connection reset')
+        return dest
+
+    mocker.patch('miqa.core.tasks._download_s3_to_file', side_effect=download)
+
+    with pytest.raises(OSError):
+        for _frame, dest in _prefetch_s3_frames(frames, tmp_path):
+            dest.unlink()  # evaluated
+
+    assert list(tmp_path.iterdir()) == []
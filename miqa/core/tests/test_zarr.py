@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 import shutil
@@ -5,6 +6,7 @@ import shutil
 from django.conf import settings
 
 from miqa.core.conversion.nifti_to_zarr_ngff import nifti_to_zarr_ngff
+from miqa.core.conversion.pyramid import pyramid_source, pyramid_source_file, pyramid_store_id
 
 
 def test_convert_to_zarr():
@@ -33,3 +35,21 @@ def test_convert_to_zarr():
         result_path = nifti_to_zarr_ngff(str(sample))
         assert str(result_path) == result
         assert os.path.exists(result)
+        assert pyramid_store_id(sample) is not None
+        assert not list(sample.parent.glob('*.partial'))
+
+
+def test_pyramid_store_id(tmp_path):
+    image = tmp_path / 'image.nii.gz'
+    image.write_bytes(b'image')
+    store = tmp_path / 'image.nii.gz.zarr'
+    store.mkdir()
+    # a store without its marker is still being written
+    assert pyramid_store_id(image) is None
+
+    (store / pyramid_source_file).write_text(json.dumps({**pyramid_source(image), 'id': 'a'}))
+    assert pyramid_store_id(image) == 'a'
+
+    # the image was replaced after the store was written
+    image.write_bytes(b'new image')
+    assert pyramid_store_id(image) is None
@@ -1,10 +1,18 @@
+from __future__ import annotations
+
 from abc import ABC, abstractclassmethod
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
 from pathlib import Path
-from typing import List
+import threading
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
 
 from uri import URI
 
-from miqa.learning.nn_inference import get_model
+from miqa.learning.inference_backends import use_backend
+from miqa.learning.nn_inference import get_device, get_model, load_quantized_model
 
 
 class EvaluationModel(ABC):
@@ -18,10 +26,151 @@ class EvaluationModel(ABC):
         pass
 
 
+@lru_cache(maxsize=None)
+def _file_checksum(path: str, mtime: float) -> str:
+    # mtime is part of the cache key, so that replaced weights files are hashed again
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def model_size_in_bytes(model) -> int:
+    """Estimate the memory held by a model's parameters and buffers."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelCache:
+    """
+    Process-wide LRU cache of loaded models.
+
+    Models are keyed by weights file, device and variant (e.g. the execution backend), so each
+    worker process only pays the cost of constructing a model and reading its weights once.
+    The least recently used models are evicted when either the number of models or their total
+    size exceeds the configured limits.
+    """
+
+    def __init__(self, max_models: int = 4, max_bytes: Optional[int] = None):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._models: OrderedDict[Tuple[str, str, str], Tuple[object, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_models: int, max_bytes: Optional[int] = None):
+        with self._lock:
+            self.max_models = max_models
+            self.max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for _model, size in self._models.values())
+
+    def get(self, file_path: str, device: str, loader: Callable, variant: str = 'eager'):
+        key = (file_path, device, variant)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+            model = loader()
+            self._models[key] = (model, model_size_in_bytes(model))
+            self._evict()
+            return model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def _evict(self):
+        # never evict the most recently used model, even if it alone exceeds the memory cap
+        while len(self._models) > 1 and (
+            len(self._models) > self.max_models
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            self._models.popitem(last=False)
+
+    def __contains__(self, key: Tuple[str, str, str]) -> bool:
+        return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+model_cache = ModelCache()
+
+
 class NNModel(EvaluationModel):
+    """
+    A TiledClassifier, identified by the name of its weights file in the models directory.
+
+    The execution backend is chosen with a query parameter, e.g. "miqaT1-val0.pth?backend=onnx".
+    Alternatively, "?quantization=dynamic" quantizes the model to int8 when it is loaded, and
+    "?quantization=static" loads the int8 model calibrated by "./manage.py quantize_model".
+    """
+
+    @property
+    def _query(self) -> dict:
+        return parse_qs(urlsplit(str(self.uri)).query)
+
+    @property
+    def path(self) -> Path:
+        return Path(__file__).parent / 'models' / urlsplit(str(self.uri)).path
+
+    @property
+    def backend(self) -> str:
+        return self._query.get('backend', ['eager'])[0]
+
+    @property
+    def quantization(self) -> Optional[str]:
+        return self._query.get('quantization', [None])[0]
+
+    @property
+    def quantized_path(self) -> Path:
+        return self.path.with_suffix('.int8.pt')
+
+    def _calibrated_path(self) -> Path:
+        quantized_path = self.quantized_path
+        if not quantized_path.exists():
+            raise FileNotFoundError(
+                f'The statically quantized model {quantized_path} does not exist. Calibrate it '
+                f'first with "./manage.py quantize_model --project <project name> <model name>".'
+            )
+        return quantized_path
+
+    @property
+    def variant(self) -> str:
+        return f'int8-{self.quantization}' if self.quantization else self.backend
+
+    @property
+    def weights_checksum(self) -> str:
+        path = self.path
+        return _file_checksum(str(path), path.stat().st_mtime)
+
+    @property
+    def checksum(self) -> str:
+        """Identify the weights and variant, to tell whether cached results are still valid."""
+        if self.variant == 'eager':
+            return self.weights_checksum
+        # other variants give slightly different results, which must not be mixed up with eager
+        # results; the calibrated int8 model may be replaced in place by quantize_model
+        key = f'{self.weights_checksum}:{self.variant}'
+        if self.quantization == 'static':
+            quantized_path = self._calibrated_path()
+            key += ':' + _file_checksum(str(quantized_path), quantized_path.stat().st_mtime)
+        return hashlib.sha256(key.encode()).hexdigest()
+
     def load(self):
-        path = Path(__file__).parent / 'models' / str(self.uri)
-        return get_model(str(path))
+        return model_cache.get(str(self.path), str(get_device()), self._load, self.variant)
+
+    def _load(self):
+        if self.quantization == 'static':
+            return load_quantized_model(get_model(str(self.path)), str(self._calibrated_path()))
+        if self.quantization:
+            return get_model(str(self.path), quantization=self.quantization)
+        return use_backend(get_model(str(self.path)), self.backend, self.weights_checksum)
 
 
 available_evaluation_models = {
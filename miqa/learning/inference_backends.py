@@ -0,0 +1,160 @@
+"""
+Optimized execution backends for evaluation models.
+
+TiledClassifier splits images into fixed-size tiles, so only the network which processes the
+tiles needs to be exported. The exported network is plugged back into the model as its
+tile_runner, and the tiling and averaging keep running in PyTorch.
+"""
+
+from abc import ABC, abstractmethod
+import logging
+import os
+from pathlib import Path
+import tempfile
+
+import torch
+
+from miqa.learning.nn_inference import TileNetwork, example_tiles, label_results
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(ABC):
+    name = ''
+    suffix = ''
+
+    @abstractmethod
+    def export(self, model, export_path: Path):
+        pass
+
+    @abstractmethod
+    def load(self, export_path: Path, device):
+        pass
+
+
+class TorchScriptRunner:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, tiles):
+        return self.module(tiles)
+
+
+class TorchScriptBackend(Backend):
+    name = 'torchscript'
+    suffix = '.torchscript.pt'
+
+    def export(self, model, export_path: Path):
+        with torch.no_grad():
+            traced = torch.jit.trace(TileNetwork(model).eval(), example_tiles(model))
+        # freezing inlines the weights, which enables folding and fusing operations
+        torch.jit.save(torch.jit.freeze(traced), str(export_path))
+
+    def load(self, export_path: Path, device):
+        module = torch.jit.load(str(export_path), map_location=device)
+        # the optimized graph is specific to this machine, so it is not part of the export
+        return TorchScriptRunner(torch.jit.optimize_for_inference(module))
+
+
+class OnnxRunner:
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, tiles):
+        (outputs,) = self.session.run(None, {'tiles': tiles.detach().cpu().numpy()})
+        return torch.from_numpy(outputs).to(tiles.device)
+
+
+class OnnxBackend(Backend):
+    name = 'onnx'
+    suffix = '.onnx'
+
+    def export(self, model, export_path: Path):
+        torch.onnx.export(
+            TileNetwork(model).eval(),
+            (example_tiles(model, count=2),),
+            str(export_path),
+            input_names=['tiles'],
+            output_names=['outputs'],
+            dynamic_axes={'tiles': {0: 'tiles'}, 'outputs': {0: 'tiles'}},
+        )
+
+    def load(self, export_path: Path, device):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('The onnx backend requires onnxruntime to be installed.')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(
+            str(export_path), options, providers=['CPUExecutionProvider']
+        )
+        return OnnxRunner(session)
+
+
+backends = {backend.name: backend for backend in [TorchScriptBackend(), OnnxBackend()]}
+
+
+def default_export_dir() -> Path:
+    return Path(tempfile.gettempdir()) / 'miqa-models'
+
+
+def check_parity(model, tile_runner, tolerance=1e-3) -> bool:
+    """Check that a tile runner gives the same labeled results as the eager PyTorch model."""
+    # an image which spans several tiles in every dimension, in a batch of two
+    generator = torch.Generator().manual_seed(0)
+    shape = [2, model.in_channels] + [size + size // 2 for size in model.in_shape]
+    inputs = torch.rand(shape, generator=generator).to(next(model.parameters()).device)
+
+    previous_runner = model.tile_runner
+    model.eval()
+    with torch.no_grad():
+        try:
+            model.tile_runner = None
+            expected = model(inputs).cpu().tolist()
+            model.tile_runner = tile_runner
+            actual = model(inputs).cpu().tolist()
+        finally:
+            model.tile_runner = previous_runner
+
+    for expected_result, actual_result in zip(expected, actual):
+        expected_labels = label_results(expected_result)
+        actual_labels = label_results(actual_result)
+        for label, value in expected_labels.items():
+            if abs(actual_labels[label] - value) > tolerance:
+                logger.warning(f'{label} differs: {actual_labels[label]} instead of {value}')
+                return False
+    return True
+
+
+def use_backend(model, backend_name: str, checksum: str, export_dir=None, tolerance=1e-3):
+    """
+    Run the tiles of a model through a network exported for the given backend.
+
+    The export is done once per weights checksum and stored in export_dir. If the exported
+    network does not reproduce the results of the eager model, the eager model is kept.
+    """
+    if backend_name == 'eager':
+        return model
+    if backend_name not in backends:
+        raise ValueError(
+            f'Unknown backend {backend_name}. Valid backends are {["eager"] + list(backends)}.'
+        )
+    backend = backends[backend_name]
+
+    export_path = Path(export_dir or default_export_dir()) / f'{checksum}{backend.suffix}'
+    if not export_path.exists():
+        export_path.parent.mkdir(parents=True, exist_ok=True)
+        # other processes may be exporting the same model, so only publish complete files
+        partial_path = export_path.with_name(f'{export_path.name}.{os.getpid()}.partial')
+        backend.export(model, partial_path)
+        os.replace(partial_path, export_path)
+        logger.info(f'Exported NN model for the {backend_name} backend to "{export_path}"')
+
+    tile_runner = backend.load(export_path, next(model.parameters()).device)
+    if check_parity(model, tile_runner, tolerance):
+        model.tile_runner = tile_runner
+    else:
+        logger.warning(f'Results of the {backend_name} backend do not match, using PyTorch')
+    return model
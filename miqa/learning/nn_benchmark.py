@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+import argparse
+from datetime import datetime, timezone
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from nn_inference import (
+    ReorientAndRescale,
+    artifacts,
+    configure_worker,
+    evaluate1,
+    evaluate_many,
+    get_model,
+    regression_count,
+)
+import numpy as np
+import pandas as pd
+import torch
+import torchio
+
+logger = logging.getLogger(__name__)
+
+# typical dimensions of the scan types we evaluate, in voxels
+volume_presets = {
+    't1': (256, 256, 180),
+    't2': (256, 256, 60),
+    'dti': (128, 128, 60),
+    'small': (64, 64, 64),
+}
+
+
+def make_synthetic_volume(path, shape, seed=0, lps=True):
+    """Write a NIfTI image which looks roughly like a head: a bright ellipsoid plus noise."""
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, size) for size in shape], indexing='ij')
+    radius = sum((axis / 0.8) ** 2 for axis in grid)
+    data = 800 * (radius < 1) + rng.normal(100, 30, shape)
+    data = np.clip(data, 0, None).astype(np.int16)
+
+    affine = np.diag([1.0, 1.0, 1.2, 1.0])
+    if lps:  # otherwise the image is RAS, and needs to be reoriented during preprocessing
+        affine[0, 0] = -1.0
+        affine[1, 1] = -1.0
+    image = torchio.ScalarImage(tensor=data[np.newaxis], affine=affine)
+    image.save(path)
+    return path
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak over the lifetime of the process, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_stage(name, function, repeat, scans_per_call=1):
+    resettable = reset_peak_rss()
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    stats = {
+        'mean_s': statistics.mean(durations),
+        'median_s': statistics.median(durations),
+        'min_s': min(durations),
+        'max_s': max(durations),
+        'repeat': repeat,
+        'scans_per_sec': scans_per_call / statistics.median(durations),
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_is_per_stage': resettable,
+    }
+    logger.info(f'{name}: {stats["median_s"]:.3f}s median, {stats["peak_rss_mb"]:.0f}MB peak RSS')
+    return stats, result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(image_paths, model_file, repeat, batch_size=1):
+    stages = {}
+    stages['get_model'], model = time_stage('get_model', lambda: get_model(model_file), repeat)
+    model.eval()
+
+    def load():
+        return torchio.Subject(
+            {
+                'img': torchio.ScalarImage(image_paths[0]),
+                'info': torch.FloatTensor([0] * (regression_count + len(artifacts))),
+            }
+        )
+
+    def decode():
+        subject = load()
+        subject.load()
+        return subject
+
+    stages['decode'], subject = time_stage('decode', decode, repeat)
+    rescale = ReorientAndRescale(out_min_max=(0, 1))
+    stages['reorient_and_rescale'], subject = time_stage(
+        'reorient_and_rescale', lambda: rescale(subject), repeat
+    )
+
+    inputs = subject['img'][torchio.DATA].unsqueeze(0)
+
+    def forward():
+        with torch.no_grad():
+            return model(inputs)
+
+    stages['tiled_forward'], _ = time_stage('tiled_forward', forward, repeat)
+    stages['evaluate1'], _ = time_stage(
+        'evaluate1', lambda: evaluate1(model, image_paths[0]), repeat
+    )
+    stages['evaluate_many'], _ = time_stage(
+        'evaluate_many',
+        lambda: evaluate_many(model, image_paths, batch_size=batch_size),
+        repeat,
+        scans_per_call=len(image_paths),
+    )
+    return stages
+
+
+def concurrent_worker(
+    image_paths, model_file, concurrency, process_index, threads, pin, barrier, durations
+):
+    configure_worker(concurrency, process_index, threads=threads, pin=pin)
+    model = get_model(model_file)
+    evaluate1(model, image_paths[0])  # warm up, like a worker which already evaluated a scan
+    barrier.wait()
+    start = time.perf_counter()
+    evaluate_many(model, image_paths)
+    durations.put(time.perf_counter() - start)
+
+
+def run_concurrency_benchmark(image_paths, model_file, concurrency_levels, thread_counts, pin):
+    """
+    Measure the throughput of several worker processes evaluating scans at the same time.
+
+    This mimics a Celery prefork worker, whose processes are configured by configure_worker.
+    A thread count of 0 stands for the default, an even share of the cores.
+    """
+    # spawn instead of fork, so every process starts with fresh torch thread pools
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for concurrency in concurrency_levels:
+        for threads in thread_counts:
+            barrier = context.Barrier(concurrency)
+            durations = context.Queue()
+            processes = [
+                context.Process(
+                    target=concurrent_worker,
+                    args=(
+                        image_paths,
+                        model_file,
+                        concurrency,
+                        process_index,
+                        threads or None,
+                        pin,
+                        barrier,
+                        durations,
+                    ),
+                )
+                for process_index in range(concurrency)
+            ]
+            for process in processes:
+                process.start()
+            elapsed = max(durations.get() for _ in processes)
+            for process in processes:
+                process.join()
+            result = {
+                'concurrency': concurrency,
+                'threads': threads or max(1, (os.cpu_count() or 1) // concurrency),
+                'pinned': pin,
+                'seconds': elapsed,
+                'scans_per_sec': concurrency * len(image_paths) / elapsed,
+            }
+            logger.info(
+                f'{concurrency} processes with {result["threads"]} threads: '
+                f'{result["scans_per_sec"]:.2f} scans/sec'
+            )
+            results.append(result)
+    return results
+
+
+def train_epoch(model, train_loader, loss_function, optimizer):
+    for batch_data in train_loader:
+        optimizer.zero_grad()
+        outputs = model(batch_data['img'][torchio.DATA])
+        loss_function(outputs, batch_data['info']).backward()
+        optimizer.step()
+
+
+def run_training_benchmark(image_paths, model_file, batch_sizes):
+    """
+    Measure the training throughput with several batch sizes, batch size 1 being the default.
+
+    One epoch over the images is timed, after an untimed epoch which fills the cache of
+    preprocessed volumes.
+    """
+    # imported here, since importing nn_training seeds the random number generators and makes
+    # torch deterministic
+    from nn_training import CombinedLoss, create_train_and_test_data_loaders
+
+    df = pd.DataFrame(
+        {
+            'file_path': image_paths,
+            'overall_qa_assessment': [8] * len(image_paths),
+            'absent': [None] * len(image_paths),  # no artifact ground truth
+        }
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for batch_size in batch_sizes:
+            train_loader, _, class_weights, _ = create_train_and_test_data_loaders(
+                df, len(df), cache_dir, batch_size
+            )
+            model = get_model(model_file)
+            model.train()
+            loss_function = CombinedLoss(class_weights)
+            optimizer = torch.optim.AdamW(model.parameters(), 9e-5)
+
+            train_epoch(model, train_loader, loss_function, optimizer)
+            start = time.perf_counter()
+            train_epoch(model, train_loader, loss_function, optimizer)
+            seconds = time.perf_counter() - start
+            result = {
+                'batch_size': batch_size,
+                'seconds': seconds,
+                'samples_per_sec': len(image_paths) / seconds,
+            }
+            logger.info(f'training with batch size {batch_size}: {result["samples_per_sec"]:.2f}/s')
+            results.append(result)
+    return results
+
+
+def compare(current, baseline):
+    """Log how much each stage changed relative to a previous run."""
+    for name, stats in current['stages'].items():
+        if name in baseline['stages']:
+            ratio = stats['median_s'] / baseline['stages'][name]['median_s']
+            logger.info(f'{name}: {ratio:.2f}x the median time of {baseline["commit"]}')
+
+
+if __name__ == '__main__':
+    # the benchmark is about CPU inference workers, so keep torch away from any GPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark MIQA inference on synthetic data')
+    parser.add_argument(
+        '--size',
+        '-s',
+        help='Volume size preset',
+        choices=sorted(volume_presets.keys()),
+        default='t1',
+    )
+    parser.add_argument(
+        '--count', '-n', help='Number of scans for evaluate_many', type=int, default=4
+    )
+    parser.add_argument('--repeat', '-r', help='Timed repetitions per stage', type=int, default=3)
+    parser.add_argument(
+        '--batch-size', '-b', help='Volumes per batch in evaluate_many', type=int, default=1
+    )
+    parser.add_argument(
+        '--concurrency',
+        help='Comma separated numbers of concurrent worker processes to benchmark',
+        type=str,
+    )
+    parser.add_argument(
+        '--threads',
+        help='Comma separated torch thread counts per worker process (0 for an even share)',
+        type=str,
+        default='0',
+    )
+    parser.add_argument(
+        '--pin', help='Pin worker processes to cores', action='store_true', default=False
+    )
+    parser.add_argument(
+        '--training-batch-sizes',
+        help='Comma separated batch sizes to benchmark training with',
+        type=str,
+    )
+    parser.add_argument('--modelfile', '-m', help='Path to neural network model weights', type=str)
+    parser.add_argument('--output', '-o', help='Path of the JSON report', type=str)
+    parser.add_argument('--compare', '-c', help='JSON report of a previous run', type=str)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        shape = volume_presets[args.size]
+        image_paths = [
+            make_synthetic_volume(
+                str(Path(tmpdirname) / f'synthetic{index}.nii.gz'),
+                shape,
+                seed=index,
+                lps=index % 2 == 0,
+            )
+            for index in range(args.count)
+        ]
+        stages = run_benchmark(image_paths, args.modelfile, args.repeat, args.batch_size)
+        concurrency = None
+        if args.concurrency:
+            concurrency = run_concurrency_benchmark(
+                image_paths,
+                args.modelfile,
+                [int(value) for value in args.concurrency.split(',')],
+                [int(value) for value in args.threads.split(',')],
+                args.pin,
+            )
+        training = None
+        if args.training_batch_sizes:
+            training = run_training_benchmark(
+                image_paths,
+                args.modelfile,
+                [int(value) for value in args.training_batch_sizes.split(',')],
+            )
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'cpu_count': os.cpu_count(),
+        'volume_shape': shape,
+        'scan_count': args.count,
+        'batch_size': args.batch_size,
+        'stages': stages,
+        'concurrency': concurrency,
+        'training': training,
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(report_json)
+        logger.info(f'Benchmark report written: {Path(args.output).absolute()}')
+    else:
+        print(report_json)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(report, json.load(fd))
@@ -1,8 +1,18 @@
+from contextlib import contextmanager
+import copy
+from functools import partial
+import gzip
+import io
 import logging
 import math
+import os
+from pathlib import Path
+import tempfile
+import time
 
 import itk
 import monai
+import nibabel
 import numpy as np
 from sklearn.metrics import classification_report, confusion_matrix, mean_squared_error, r2_score
 import torch
@@ -30,55 +40,230 @@ artifact_names = {
     for artifact in artifacts
 }
 
+# callables which receive (stage, seconds, bytes) for every timed stage of inference
+stage_listeners = []
+
+
+def record_stage(stage, seconds, nbytes=0):
+    for listener in stage_listeners:
+        listener(stage, seconds, nbytes)
+
+
+@contextmanager
+def timed_stage(stage, nbytes=0):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, nbytes)
+
 
 class TiledClassifier(monai.networks.nets.Classifier):
+    # how many tiles are run through the NN in one forward pass, None means all of them
+    tile_batch_size = 8
+    # optimized replacement for the network which processes the tiles, see inference_backends
+    tile_runner = None
+
+    def tile_starts(self, inputs):
+        # tiles are spread evenly, so that the last tile ends at the image boundary
+        starts = []
+        for dim in range(3):
+            tile_size = self.in_shape[dim]
+            size = inputs.shape[2 + dim]
+            steps = math.ceil(size / tile_size)
+            starts.append(
+                [round(step * (size - tile_size) / max(1, steps - 1)) for step in range(steps)]
+            )
+        return [(k, j, i) for k in starts[0] for j in starts[1] for i in starts[2]]
+
     def forward(self, inputs):
-        # split the input image into tiles and run each tile through NN
-        results = []
+        start = time.perf_counter()
+        # split the input image into tiles and run batches of tiles through NN
         z_tile_size = self.in_shape[0]
         y_tile_size = self.in_shape[1]
         x_tile_size = self.in_shape[2]
-        z_size = inputs.shape[2]
-        y_size = inputs.shape[3]
-        x_size = inputs.shape[4]
-        z_steps = math.ceil(z_size / z_tile_size)
-        y_steps = math.ceil(y_size / y_tile_size)
-        x_steps = math.ceil(x_size / x_tile_size)
-        for k in range(z_steps):
-            k_start = round(k * (z_size - z_tile_size) / max(1, z_steps - 1))
-            for j in range(y_steps):
-                j_start = round(j * (y_size - y_tile_size) / max(1, y_steps - 1))
-                for i in range(x_steps):
-                    i_start = round(i * (x_size - x_tile_size) / max(1, x_steps - 1))
-
-                    # use slicing operator to make a tile
-                    tile = inputs[
-                        :,
-                        :,
-                        k_start : k_start + z_tile_size,
-                        j_start : j_start + y_tile_size,
-                        i_start : i_start + x_tile_size,
-                    ]
-
-                    # check if the tile is smaller than our NN input
-                    x_pad = max(0, x_tile_size - x_size)
-                    y_pad = max(0, y_tile_size - y_size)
-                    z_pad = max(0, z_tile_size - z_size)
-
-                    if x_pad + y_pad + z_pad > 0:  # we need to pad
-                        tile = torch.nn.functional.pad(
-                            tile, (0, x_pad, 0, y_pad, 0, z_pad), 'replicate'
-                        )
-
-                    results.append(super().forward(tile))
+
+        # check if the image is smaller than our NN input
+        x_pad = max(0, x_tile_size - inputs.shape[4])
+        y_pad = max(0, y_tile_size - inputs.shape[3])
+        z_pad = max(0, z_tile_size - inputs.shape[2])
+
+        tiles = []
+        for k_start, j_start, i_start in self.tile_starts(inputs):
+            # use slicing operator to make a tile
+            tile = inputs[
+                :,
+                :,
+                k_start : k_start + z_tile_size,
+                j_start : j_start + y_tile_size,
+                i_start : i_start + x_tile_size,
+            ]
+            if x_pad + y_pad + z_pad > 0:  # we need to pad
+                tile = torch.nn.functional.pad(tile, (0, x_pad, 0, y_pad, 0, z_pad), 'replicate')
+            tiles.append(tile)
+
+        # tiles of all images in the input batch are stacked tile-major: [tile, image, ...]
+        batch_size = inputs.shape[0]
+        tiles_per_pass = self.tile_batch_size or len(tiles)
+        results = []
+        forward_seconds = 0.0
+        for chunk_start in range(0, len(tiles), tiles_per_pass):
+            chunk = torch.cat(tiles[chunk_start : chunk_start + tiles_per_pass], dim=0)
+            forward_start = time.perf_counter()
+            results.append(self.forward_tiles(chunk))
+            forward_seconds += time.perf_counter() - forward_start
+        results = torch.cat(results, dim=0).reshape(len(tiles), batch_size, -1)
 
         # TODO: do something smarter than mean here
-        average = torch.mean(torch.stack(results), dim=0)
+        average = torch.mean(results, dim=0)
+
+        # tiling is everything except running the network
+        nbytes = inputs.element_size() * inputs.nelement()
+        record_stage('forward', forward_seconds, nbytes)
+        record_stage('tiling', time.perf_counter() - start - forward_seconds, nbytes)
         return average
 
+    def forward_tiles(self, tiles):
+        if self.tile_runner is not None:
+            return self.tile_runner(tiles)
+        return super().forward(tiles)
+
+
+class TileNetwork(torch.nn.Module):
+    """The network of a TiledClassifier which processes a batch of tiles, for export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tiles):
+        return self.model.forward_tiles(tiles)
+
+
+def example_tiles(model, count=1):
+    device = next(model.parameters()).device
+    return torch.zeros(count, model.in_channels, *model.in_shape, device=device)
+
+
+class QuantizedTileRunner:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, tiles):
+        # quantized operators are only implemented for CPU
+        return self.module(tiles.cpu()).to(tiles.device)
+
+
+def quantize_model(model, calibration_paths=None):
+    """
+    Make a copy of a model whose tile network runs with int8 weights on CPU.
+
+    Without calibration images, only the fully connected layer is quantized (dynamic
+    quantization, as PyTorch has no dynamically quantized convolutions). With calibration
+    images, the convolutions are quantized too, using activation ranges observed while
+    evaluating those images (static quantization).
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
 
-def get_model(file_path=None):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    quantized_model = copy.deepcopy(model).cpu().eval()
+    quantized_model.tile_runner = None
+    tile_network = TileNetwork(copy.deepcopy(quantized_model)).eval()
+
+    if not calibration_paths:
+        quantized = quantize_dynamic(tile_network, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        prepared = prepare_fx(
+            tile_network, get_default_qconfig_mapping(), (example_tiles(quantized_model),)
+        )
+        # observe the range of activations while evaluating the calibration images
+        quantized_model.tile_runner = QuantizedTileRunner(prepared)
+        evaluate_many(quantized_model, calibration_paths)
+        quantized = convert_fx(prepared)
+
+    quantized_model.tile_runner = QuantizedTileRunner(quantized)
+    return quantized_model
+
+
+def save_quantized_model(model, file_path):
+    """Save the quantized tile network of a model, so it can be reused without calibration."""
+    with torch.no_grad():
+        traced = torch.jit.trace(model.tile_runner.module, example_tiles(model))
+    torch.jit.save(torch.jit.freeze(traced), file_path)
+
+
+def load_quantized_model(model, file_path):
+    model.cpu()
+    model.tile_runner = QuantizedTileRunner(torch.jit.load(file_path, map_location='cpu'))
+    return model
+
+
+# overrides the automatic choice of get_device, see configure_worker
+inference_device = None
+
+
+def get_device():
+    if inference_device is not None:
+        return torch.device(inference_device)
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def worker_cores(concurrency, process_index, threads=None):
+    """
+    Choose the cores one of several inference worker processes should run on.
+
+    The cores available to the parent process are shared evenly by the workers, unless each
+    worker is given a number of threads, in which case workers wrap around the cores.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if not cores:
+        cores = list(range(os.cpu_count() or 1))
+    threads = threads or max(1, len(cores) // concurrency)
+    first = process_index * threads
+    return [cores[(first + offset) % len(cores)] for offset in range(min(threads, len(cores)))]
+
+
+def configure_worker(
+    concurrency, process_index=0, threads=None, interop_threads=1, pin=False, device=None
+):
+    """
+    Size the torch thread pools of one of several concurrent inference processes.
+
+    By default every process would use one intra-op thread per core, so N processes on an N
+    core machine run N^2 threads. Instead, each process gets an equal share of the cores
+    (at least one), and is optionally pinned to those cores. On machines with several GPUs,
+    a device of 'cuda' spreads the processes over all of them.
+    """
+    global inference_device
+
+    cores = worker_cores(concurrency, process_index, threads)
+    threads = threads or len(cores)
+    if pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # the inter-op pool is created on first use, and cannot be resized afterwards
+        logger.warning('Torch inter-op threads were already started, not resizing them')
+
+    if device == 'cuda' and torch.cuda.device_count() > 1:
+        device = f'cuda:{process_index % torch.cuda.device_count()}'
+    inference_device = device
+    logger.info(
+        f'Inference process {process_index} of {concurrency}: {threads} threads'
+        + (f' pinned to cores {cores}' if pin else '')
+        + (f' on {device}' if device else '')
+    )
+
+
+def get_model(
+    file_path=None,
+    tile_batch_size=TiledClassifier.tile_batch_size,
+    quantization=None,
+    calibration_paths=None,
+):
+    device = get_device()
 
     model = TiledClassifier(
         in_shape=(1, 64, 64, 64),
@@ -87,6 +272,7 @@ def get_model(file_path=None):
         strides=(2, 2, 2, 2, 2),
         dropout=0.1,
     )
+    model.tile_batch_size = tile_batch_size
 
     if file_path is not None:
         model.load_state_dict(torch.load(file_path, map_location=device))
@@ -96,6 +282,13 @@ def get_model(file_path=None):
 
     model.to(device)
 
+    if quantization == 'dynamic':
+        model = quantize_model(model)
+    elif quantization == 'static':
+        model = quantize_model(model, calibration_paths)
+    elif quantization is not None:
+        raise ValueError(f'Unknown quantization {quantization}, expected dynamic or static')
+
     return model
 
 
@@ -166,29 +359,209 @@ def get_torchio_image_from_itk_image(image):
     return img
 
 
+def reorient_to_lps(img):
+    """
+    Reorient an axis-aligned image into DICOM LPS by permuting and flipping its axes.
+
+    This gives the same result as running itk.OrientImageFilter on the image view created by
+    get_itk_image_view_from_torchio_image, which maps axis t of the array to ITK axis 2 - t.
+    Returns None if the image directions are oblique, and an ITK filter is needed.
+    """
+    origin, spacing, direction = get_itk_metadata_from_ras_affine(img.affine)
+    signed_permutation = np.round(direction)
+    if not np.allclose(direction, signed_permutation, atol=1e-3) or not np.array_equal(
+        np.abs(signed_permutation).sum(axis=0), np.ones(3)
+    ):
+        return None
+    if np.array_equal(signed_permutation, np.eye(3)):
+        return img
+
+    # ITK axis c becomes the output axis along its physical direction, reversed if negative
+    output_axes = np.abs(signed_permutation).argmax(axis=0)
+    signs = signed_permutation.sum(axis=0)
+    itk_sizes = np.array(img.spatial_shape[::-1])
+    # physical position of the voxel which becomes the new origin
+    first_index = np.where(signs < 0, itk_sizes - 1, 0)
+    origin = origin + direction @ (spacing * first_index)
+    flip_axes = np.zeros((3, 3))
+    flip_axes[np.arange(3), output_axes] = signs
+    direction = direction @ flip_axes
+    spacing = spacing[np.argsort(output_axes)]
+
+    # array axes are in the reverse order of ITK axes, after the channel dimension
+    source_axes = [2 - c for c in np.argsort(output_axes)][::-1]
+    tensor = img.data.permute(0, *[axis + 1 for axis in source_axes])
+    flipped = [axis + 1 for axis in range(3) if signs[2 - source_axes[axis]] < 0]
+    if flipped:
+        tensor = tensor.flip(flipped)
+
+    flip_xy_33 = np.diag([-1, -1, 1])
+    affine = np.eye(4)
+    affine[:3, :3] = np.dot(flip_xy_33, direction) * spacing
+    affine[:3, 3] = np.dot(flip_xy_33, origin)
+    return torchio.ScalarImage(tensor=tensor, affine=affine, check_nans=False)
+
+
+def reorient_with_itk(img):
+    """Reorient an image into DICOM LPS with itk.OrientImageFilter, which handles oblique images."""
+    itk_np_view = get_itk_image_view_from_torchio_image(img)
+
+    # reorient all images into DICOM LPS
+    itk_so_enums = itk.SpatialOrientationEnums  # keep the next long line below style threshold
+    itk_lps = itk_so_enums.ValidCoordinateOrientations_ITK_COORDINATE_ORIENTATION_RAI
+    orient_filter = itk.OrientImageFilter.New(
+        itk_np_view,
+        use_image_direction=True,
+        desired_coordinate_orientation=itk_lps,
+    )
+    orient_filter.UpdateOutputInformation()
+
+    # if original direction was not LPS, we need to run the filter and update the pixel data
+    if np.any(orient_filter.GetOutput().GetDirection() != itk_np_view.GetDirection()):
+        orient_filter.Update()
+        return get_torchio_image_from_itk_image(orient_filter.GetOutput())
+    return img
+
+
+def decompress_first_volume(compressed, decompressed):
+    """
+    Copy the header, header extensions and first volume of a NIfTI file between file objects.
+
+    The header of a 4D series is rewritten to describe the copied volume, and the following
+    volumes are not decompressed at all.
+    """
+    header_bytes = compressed.read(nibabel.Nifti2Header.template_dtype.itemsize)
+    sizeof_hdr = header_bytes[:4]
+    if nibabel.Nifti2Header.sizeof_hdr in (
+        int.from_bytes(sizeof_hdr, 'little'),
+        int.from_bytes(sizeof_hdr, 'big'),
+    ):
+        header_class = nibabel.Nifti2Header
+    else:
+        header_class = nibabel.Nifti1Header
+    header = header_class.from_fileobj(io.BytesIO(header_bytes[: header_class.sizeof_hdr]))
+
+    shape = header.get_data_shape()
+    volume_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+    data_end = int(header.get_data_offset()) + volume_bytes
+    header.set_data_shape(shape[:3])
+    decompressed.write(header.binaryblock)
+    decompressed.write(header_bytes[header_class.sizeof_hdr : data_end])
+    remaining = data_end - len(header_bytes)
+    while remaining > 0:
+        chunk = compressed.read(min(remaining, 2**20))
+        if not chunk:
+            break
+        decompressed.write(chunk)
+        remaining -= len(chunk)
+
+
+def read_memory_mapped(image_path):
+    """
+    Read a NIfTI image as a memory map, for use as the reader of a torchio image.
+
+    Voxels are paged in from the file as they are used, instead of being decoded into memory.
+    Of a .nii.gz file, the first volume is decompressed into a temporary file, which is
+    deleted as soon as it is mapped. Of a 4D series, only the first volume is read, since the
+    network evaluates 3D images. Other formats are read by torchio.
+    """
+    path = Path(image_path)
+    if path.name.endswith('.nii.gz'):
+        with tempfile.NamedTemporaryFile(suffix='.nii', delete=False) as decompressed:
+            pass
+        try:
+            with gzip.open(path) as compressed, open(decompressed.name, 'wb') as fd:
+                decompress_first_volume(compressed, fd)
+            return read_memory_mapped(decompressed.name)
+        finally:
+            # the mapping keeps the data of the deleted file available
+            os.unlink(decompressed.name)
+    if path.suffix != '.nii':
+        return torchio.data.io.read_image(path)
+
+    image = nibabel.load(str(path), mmap='c')
+    volume = (slice(None),) * 3 + (0,) * (len(image.shape) - 3)
+    if image.dataobj.slope == 1 and image.dataobj.inter == 0:
+        data = np.asanyarray(image.dataobj)[volume]  # a view of the memory map
+    else:
+        # scaled values are computed in memory, but only for the voxels of this volume
+        data = image.dataobj[volume]
+    if data.dtype.kind == 'u' and data.dtype.itemsize > 1:
+        data = data.astype(np.float32)  # torch has limited support for unsigned types
+    elif not data.dtype.isnative:
+        data = data.astype(data.dtype.newbyteorder('='))  # torch only reads native byte order
+    return torch.from_numpy(data[np.newaxis]), image.affine
+
+
+def read_pyramid_level(image_path, level=0):
+    """
+    Read an image from the multiscale Zarr store which nifti_to_zarr_ngff writes next to it.
+
+    Level 0 has the full resolution, and each further level is downsampled by 2. Reading
+    decompresses only the chunks of the requested level, and the header of the NIfTI file
+    provides the orientation of the image. Falls back to read_memory_mapped if there is no
+    usable store (see pyramid_store_id), or if it does not hold a 3D image.
+    """
+    # Zarr stores are only written by the MIQA server, which provides these
+    from miqa.core.conversion.pyramid import pyramid_store_id
+
+    store_path = Path(f'{image_path}.zarr')
+    if pyramid_store_id(image_path) is None:
+        return read_memory_mapped(image_path)
+    import zarr  # only installed with the zarr extra
+
+    group = zarr.open_group(zarr.NestedDirectoryStore(str(store_path)), mode='r')
+    datasets = group.attrs['multiscales'][0]['datasets']
+    level = min(level, len(datasets) - 1)
+    array = group[datasets[level]['path']]
+    if array.attrs.get('_ARRAY_DIMENSIONS', ['z', 'y', 'x']) != ['z', 'y', 'x']:
+        return read_memory_mapped(image_path)
+
+    # the store has ITK's array order, which is the reverse of TorchIO's
+    data = np.asarray(array[:]).transpose(2, 1, 0)
+    affine = nibabel.load(str(image_path)).affine
+    if level > 0:
+        # coordinates of the voxels of this level, in voxels of the full resolution image
+        base_path = datasets[0]['path'].rsplit('/', 1)[0]
+        level_path = datasets[level]['path'].rsplit('/', 1)[0]
+        to_full_resolution = np.eye(4)
+        for axis, name in enumerate(['x', 'y', 'z']):
+            base_coordinates = np.asarray(group[f'{base_path}/{name}'][:2])
+            level_coordinates = np.asarray(group[f'{level_path}/{name}'][:2])
+            spacing = base_coordinates[1] - base_coordinates[0]
+            to_full_resolution[axis, axis] = (level_coordinates[1] - level_coordinates[0]) / spacing
+            to_full_resolution[axis, 3] = (level_coordinates[0] - base_coordinates[0]) / spacing
+        affine = affine @ to_full_resolution
+    return torch.from_numpy(data[np.newaxis]), affine
+
+
+def image_reader(pyramid_level=None):
+    """Choose how images are read: from a level of their Zarr pyramid, or memory-mapped."""
+    if pyramid_level is None:
+        return read_memory_mapped
+    return partial(read_pyramid_level, level=pyramid_level)
+
+
 class ReorientAndRescale(torchio.transforms.RescaleIntensity):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
-        # rescaling intensity first gives us a copy of the data
-        transformed_subject = super().apply_transform(subject)
-
-        itk_np_view = get_itk_image_view_from_torchio_image(transformed_subject.img)
+        # images are read lazily, so read this one first to time decoding on its own
+        start = time.perf_counter()
+        subject.load()
+        nbytes = subject.img.data.element_size() * subject.img.data.nelement()
+        record_stage('decode', time.perf_counter() - start, nbytes)
 
-        # reorient all images into DICOM LPS
-        itk_so_enums = itk.SpatialOrientationEnums  # keep the next long line below style threshold
-        itk_lps = itk_so_enums.ValidCoordinateOrientations_ITK_COORDINATE_ORIENTATION_RAI
-        orient_filter = itk.OrientImageFilter.New(
-            itk_np_view,
-            use_image_direction=True,
-            desired_coordinate_orientation=itk_lps,
-        )
-        orient_filter.UpdateOutputInformation()
+        with timed_stage('reorient', nbytes):
+            return self.reorient_and_rescale(subject)
 
-        # if original direction was not LPS, we need to run the filter and update the pixel data
-        if np.any(orient_filter.GetOutput().GetDirection() != itk_np_view.GetDirection()):
-            orient_filter.Update()
-            reoriented = orient_filter.GetOutput()
-            transformed_subject['img'] = get_torchio_image_from_itk_image(reoriented)
+    def reorient_and_rescale(self, subject: torchio.Subject) -> torchio.Subject:
+        # rescaling intensity first gives us a copy of the data
+        transformed_subject = super().apply_transform(subject)
 
+        # axis-aligned images only need their axes permuted and flipped
+        reoriented = reorient_to_lps(transformed_subject.img)
+        if reoriented is None:
+            reoriented = reorient_with_itk(transformed_subject.img)
+        transformed_subject['img'] = reoriented
         return transformed_subject
 
 
@@ -196,67 +569,59 @@ def clamp(num, min_value, max_value):
     return max(min(num, max_value), min_value)
 
 
+def count_artifact_confusions(targets, outputs):
+    """Count the [TN, FP, FN, TP] of each artifact, skipping ground truth which is missing."""
+    # ground truth of -1 means it was not provided
+    y_a_true = targets[:, regression_count:]
+    y_a_out = np.clip(np.rint(outputs[:, regression_count:]), 0, 1)
+    return np.stack(
+        [
+            np.sum((y_a_true == true_value) & (y_a_out == out_value), axis=0)
+            for true_value, out_value in [(0, 0), (0, 1), (1, 0), (1, 1)]
+        ],
+        axis=1,
+    )
+
+
 def evaluate_model(model, data_loader, device, writer, epoch, run_name):
     model.eval()
-    y_pred = []
-    y_pred_continuous = []
-    y_all = []
-    y_true = []
-    y_info = np.empty([0, 10])
-    y_artifacts = np.empty([0, 10])
+    # outputs and targets are copied into preallocated arrays, and the artifact confusion
+    # matrices [TN, FP, FN, TP] are counted as batches arrive
+    result_count = len(data_loader.dataset)
+    outputs_all = np.empty((result_count, regression_count + len(artifacts)))
+    targets_all = np.empty((result_count, regression_count + len(artifacts)))
+    artifact_cm = np.zeros((len(artifacts), 4), dtype=np.int64)
     with torch.no_grad():
         metric_count = 0
         for val_data in data_loader:
             inputs = val_data['img'][torchio.DATA].to(device)
-            y_info1 = val_data['info'].numpy()[:, 1:]  # skip the overall QA
-            y_info = np.concatenate((y_info, y_info1), axis=0)
-            info = val_data['info'].to(device)
-            outputs = model(inputs)
-
-            y_all.extend(outputs[..., :].cpu().tolist())
-            y_true.extend(info[..., 0].cpu().tolist())
-            y = outputs[..., 0].cpu().tolist()
-            y_pred_continuous.extend(y)
-            y = [int(round(y[t])) for t in range(len(y))]
-            y = [clamp(y[t], 0, 10) for t in range(len(y))]
-            y_pred.extend(y)
-
-            output_artifact = outputs[..., 1:].detach().cpu()
-            y_a = output_artifact.numpy()
-            y_a = np.rint(y_a)
-            y_a = np.clip(y_a, 0, 1)
-            y_artifacts = np.concatenate((y_artifacts, y_a), axis=0)
-
-            metric_count += len(info)
+            outputs = model(inputs).cpu().numpy()
+            targets = val_data['info'].numpy()
+            outputs_all[metric_count : metric_count + len(outputs)] = outputs
+            targets_all[metric_count : metric_count + len(outputs)] = targets
+
+            artifact_cm += count_artifact_confusions(targets, outputs)
+
+            metric_count += len(outputs)
             print('.', end='', flush=True)
             if metric_count % 100 == 0:
                 print(metric_count, flush=True)
         print('')  # new line
 
+        outputs_all = outputs_all[:metric_count]
         if writer is not None:  # this is not a one-off case
+            y_true = targets_all[:metric_count, 0]
+            y_pred_continuous = outputs_all[:, 0]
+            y_pred = np.clip(np.rint(y_pred_continuous), 0, 10).astype(int)
             logger.info(f'{run_name}_confusion_matrix:\n{confusion_matrix(y_true, y_pred)}')
             logger.info(f'\n{classification_report(y_true, y_pred)}')
 
             logger.info(run_name + '_artifact_confusions [TN, FP, FN, TP]:')
-            confusions = {}
-            artifact_cm = []
             for a in range(len(artifacts)):
-                y_a_true = y_info[:, a].tolist()
-                y_a_out = y_artifacts[:, a].tolist()
-                assert len(y_a_true) == len(y_a_out)
-
-                for i in reversed(range(len(y_a_true))):
-                    if y_a_true[i] == -1:  # ground truth was not provided
-                        y_a_true.pop(i)
-                        y_a_out.pop(i)
-                cm = confusion_matrix(y_a_true, y_a_out)
-                cm_list = list(cm.flat)  # flatten into a list
-                confusions[artifacts[a]] = cm_list
-                artifact_cm.append(cm_list)
-                logger.info(f'{artifacts[a]}: {cm_list}')
-            logger.info(f'artifact_cm:\n{np.array(artifact_cm)}')
-
-            metric = mean_squared_error(y_true, y_pred_continuous, squared=False)
+                logger.info(f'{artifacts[a]}: {list(artifact_cm[a])}')
+            logger.info(f'artifact_cm:\n{artifact_cm}')
+
+            metric = np.sqrt(mean_squared_error(y_true, y_pred_continuous))
             writer.add_scalar(run_name + '_RMSE', metric, epoch + 1)
             wandb.log({run_name + '_RMSE': metric})
             metric = r2_score(y_true, y_pred_continuous)
@@ -264,7 +629,7 @@ def evaluate_model(model, data_loader, device, writer, epoch, run_name):
             wandb.log({run_name + '_R2': metric})
             return metric
         else:
-            return y_all
+            return outputs_all.tolist()
 
 
 def label_results(result):
@@ -279,15 +644,15 @@ def label_results(result):
     return labeled_results
 
 
-def evaluate1(model, image_path):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+def evaluate1(model, image_path, pyramid_level=None):
+    device = get_device()
     rescale = ReorientAndRescale(out_min_max=(0, 1))
 
     evaluation_ds = monai.data.Dataset(
         data=[
             torchio.Subject(
                 {
-                    'img': torchio.ScalarImage(image_path),
+                    'img': torchio.ScalarImage(image_path, reader=image_reader(pyramid_level)),
                     'info': torch.FloatTensor([0] * (regression_count + len(artifacts))),
                 }
             )
@@ -306,23 +671,78 @@ def evaluate1(model, image_path):
     return label_results(result)
 
 
-def evaluate_many(model, image_paths):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+def read_image_header(image_path):
+    """
+    Read the dimensions of an image, and which physical axis each of its axes is closest to.
+
+    Only the header is read, not the pixel data. Images with the same header have the same
+    shape after ReorientAndRescale, so they can be stacked into one batch.
+    Returns None if ITK cannot read the header.
+    """
+    image_path = str(image_path)
+    image_io = itk.ImageIOFactory.CreateImageIO(image_path, itk.CommonEnums.IOFileMode_ReadMode)
+    if image_io is None:
+        return None
+    try:
+        image_io.SetFileName(image_path)
+        image_io.ReadImageInformation()
+    except RuntimeError:
+        return None
+    dimension = image_io.GetNumberOfDimensions()
+    shape = tuple(image_io.GetDimensions(axis) for axis in range(dimension))
+    # reorientation permutes the axes by their dominant direction, the sign does not matter
+    axis_order = tuple(
+        int(np.argmax(np.abs(image_io.GetDirection(axis)))) for axis in range(dimension)
+    )
+    return shape, axis_order
+
+
+def plan_batches(image_paths, batch_size):
+    """Group the images into batches of at most batch_size images with the same header."""
+    buckets = {}
+    for image_path in image_paths:
+        # images without a readable header are evaluated on their own
+        key = read_image_header(image_path) if batch_size > 1 else None
+        buckets.setdefault(key or image_path, []).append(image_path)
+    return [
+        bucket[start : start + batch_size]
+        for bucket in buckets.values()
+        for start in range(0, len(bucket), batch_size)
+    ]
 
+
+def evaluation_loader(image_paths, batch_size=1, pyramid_level=None):
+    """Create a DataLoader for the images, and list the paths in the order it yields them."""
+    batches = plan_batches(image_paths, batch_size)
+    image_paths = [image_path for batch in batches for image_path in batch]
     evaluation_files = [
         torchio.Subject(
             {
-                'img': torchio.ScalarImage(image_path),
+                'img': torchio.ScalarImage(image_path, reader=image_reader(pyramid_level)),
                 'info': torch.FloatTensor([0] * (regression_count + len(artifacts))),
             }
         )
         for image_path in image_paths
     ]
+    batch_indices = []
+    start = 0
+    for batch in batches:
+        batch_indices.append(list(range(start, start + len(batch))))
+        start += len(batch)
 
     rescale = ReorientAndRescale(out_min_max=(0, 1))
     evaluation_ds = monai.data.Dataset(evaluation_files, transform=rescale)
-    evaluation_loader = DataLoader(evaluation_ds, pin_memory=torch.cuda.is_available())
-    results = evaluate_model(model, evaluation_loader, device, None, 0, 'evaluate_many')
+    loader = DataLoader(
+        evaluation_ds, batch_sampler=batch_indices, pin_memory=torch.cuda.is_available()
+    )
+    return image_paths, loader
+
+
+def evaluate_many(model, image_paths, batch_size=1, pyramid_level=None):
+    device = get_device()
+
+    image_paths, loader = evaluation_loader(image_paths, batch_size, pyramid_level)
+    results = evaluate_model(model, loader, device, None, 0, 'evaluate_many')
 
     labeled_results = {}
     for index, result in enumerate(results):
@@ -330,6 +750,136 @@ def evaluate_many(model, image_paths):
     return labeled_results
 
 
+def in_uncertainty_band(result, uncertainty_bands):
+    for label, value in result.items():
+        band = uncertainty_bands.get(
+            'overall_quality' if label == 'overall_quality' else 'artifacts'
+        )
+        if band is not None and band[0] <= value <= band[1]:
+            return True
+    return False
+
+
+def evaluate_coarse_to_fine(
+    model, image_paths, uncertainty_bands, batch_size=1, pyramid_level=None
+):
+    """
+    Evaluate images at half resolution first, and at full resolution only if that is unclear.
+
+    uncertainty_bands maps 'overall_quality' and 'artifacts' (all other labels) to [low, high]
+    score ranges. If any score of the half resolution result is within its range, the image
+    is evaluated again at full resolution, and that result is returned instead.
+    """
+    device = get_device()
+
+    image_paths, loader = evaluation_loader(image_paths, batch_size, pyramid_level)
+    labeled_results = {}
+    refined_count = 0
+    model.eval()
+    with torch.no_grad():
+        start = 0
+        for evaluation_data in loader:
+            inputs = evaluation_data['img'][torchio.DATA].to(device)
+            batch_paths = image_paths[start : start + len(inputs)]
+            start += len(inputs)
+
+            coarse = torch.nn.functional.avg_pool3d(inputs, kernel_size=2, ceil_mode=True)
+            results = [label_results(output) for output in model(coarse).cpu().tolist()]
+            uncertain = [
+                index
+                for index, result in enumerate(results)
+                if in_uncertainty_band(result, uncertainty_bands)
+            ]
+            if uncertain:
+                outputs = model(inputs[uncertain]).cpu().tolist()
+                for index, output in zip(uncertain, outputs):
+                    results[index] = label_results(output)
+                refined_count += len(uncertain)
+            labeled_results.update(zip(batch_paths, results))
+
+    logger.info(f'{refined_count} of {len(image_paths)} images needed full resolution')
+    return labeled_results
+
+
+def evaluate_many_models(models, image_paths, batch_size=1, seconds=None):
+    """
+    Evaluate the images with several models, decoding and preprocessing each image only once.
+
+    models maps names to models, and the results of each model are returned under its name.
+    If a seconds dictionary is given, the time spent in each model is added to it.
+    """
+    device = get_device()
+
+    image_paths, loader = evaluation_loader(image_paths, batch_size)
+    outputs = {name: [] for name in models}
+    for model in models.values():
+        model.eval()
+    with torch.no_grad():
+        for evaluation_data in loader:
+            inputs = evaluation_data['img'][torchio.DATA].to(device)
+            for name, model in models.items():
+                start = time.perf_counter()
+                outputs[name].extend(model(inputs).cpu().tolist())
+                if seconds is not None:
+                    seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start
+
+    return {
+        name: {
+            image_path: label_results(result)
+            for image_path, result in zip(image_paths, model_outputs)
+        }
+        for name, model_outputs in outputs.items()
+    }
+
+
+def quantization_report(float_model, quantized_model, image_paths):
+    """
+    Compare the results and speed of a quantized model to those of the float model.
+
+    Both models run on the same preprocessed images, so the timings exclude decoding.
+    """
+    seconds = {}
+    results = evaluate_many_models(
+        {'float': float_model, 'quantized': quantized_model}, image_paths, seconds=seconds
+    )
+    float_results = results['float']
+    quantized_results = results['quantized']
+
+    labels = {}
+    for label in float_results[image_paths[0]]:
+        differences = np.array(
+            [
+                quantized_results[image_path][label] - float_results[image_path][label]
+                for image_path in image_paths
+            ]
+        )
+        if label == 'overall_quality':
+            # compare decisions on the 0-10 scale
+            agreement = [
+                round(10 * quantized_results[image_path][label])
+                == round(10 * float_results[image_path][label])
+                for image_path in image_paths
+            ]
+        else:
+            agreement = [
+                (quantized_results[image_path][label] > 0.5)
+                == (float_results[image_path][label] > 0.5)
+                for image_path in image_paths
+            ]
+        labels[label] = {
+            'mean_absolute_difference': float(np.mean(np.abs(differences))),
+            'max_absolute_difference': float(np.max(np.abs(differences))),
+            'agreement': float(np.mean(agreement)),
+        }
+
+    return {
+        'image_count': len(image_paths),
+        'float_seconds_per_image': seconds['float'] / len(image_paths),
+        'quantized_seconds_per_image': seconds['quantized'] / len(image_paths),
+        'labels': labels,
+    }
+
+
 if __name__ == '__main__':
     raise RuntimeError(
         'This file is not meant to be invoked by the user. Please invoke nn_training.py'
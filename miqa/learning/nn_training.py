@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import hashlib
+from itertools import chain
+import json
 import logging
 import math
+import multiprocessing
 import os
 from pathlib import Path
 import random
@@ -10,13 +17,16 @@ import sys
 import itk
 import monai
 from nn_inference import (
+    ReorientAndRescale,
     artifacts,
     clamp,
+    configure_worker,
     evaluate1,
     evaluate_model,
     get_itk_image_view_from_torchio_image,
     get_model,
     get_torchio_image_from_itk_image,
+    read_image_header,
     regression_count,
 )
 import numpy as np
@@ -74,40 +84,92 @@ def get_image_dimension(path, print_non_lps=False):
     return dim, identity
 
 
-def ncanda_construct_data_frame(ncanda_root_dir):
-    df = pd.DataFrame(
-        [],
-        columns=[
-            'participant_id',
-            'series_type',
-            'overall_qa_assessment',
-            'file_path',
-            'exists',
-            'dimensions',
-            'lps',
-            'absent',
-        ],
-    )
-
+def scan_image_headers(file_paths, cache_path=None, jobs=None):
+    """
+    Read the dimensions and orientation of many images, on a pool of jobs processes.
+
+    Results are appended to the JSON lines file at cache_path as they arrive, so an interrupted
+    scan resumes where it stopped. Cached results are reused while the file is not modified.
+    Returns a dictionary from file path to the result of get_image_dimension.
+    """
+    headers = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # the last line of an interrupted scan
+                    continue
+                headers[entry['file_path'], entry['mtime_ns']] = entry
+
+    results = {}
+    missing_paths = []
+    for file_path in file_paths:
+        entry = headers.get((file_path, os.stat(file_path).st_mtime_ns))
+        if entry is not None:
+            results[file_path] = tuple(entry['dimensions']), entry['lps']
+        else:
+            missing_paths.append(file_path)
+    logger.info(f'Reading {len(missing_paths)} image headers, {len(results)} are cached')
+    if not missing_paths:
+        return results
+
+    cache = open(cache_path, 'a') if cache_path is not None else None
+    try:
+        # reading the first header here loads the ITK IO modules, which takes seconds, once
+        # instead of in every forked process
+        first_header = get_image_dimension(missing_paths[0])
+        with ProcessPoolExecutor(jobs) as executor:
+            scanned = executor.map(get_image_dimension, missing_paths[1:], chunksize=64)
+            for file_path, (dimensions, lps) in zip(missing_paths, chain([first_header], scanned)):
+                results[file_path] = dimensions, lps
+                if cache is not None:
+                    entry = {
+                        'file_path': file_path,
+                        'mtime_ns': os.stat(file_path).st_mtime_ns,
+                        'dimensions': dimensions,
+                        'lps': lps,
+                    }
+                    cache.write(json.dumps(entry) + '\n')
+                    cache.flush()
+    finally:
+        if cache is not None:
+            cache.close()
+    return results
+
+
+def ncanda_construct_data_frame(ncanda_root_dir, cache_dir=None, jobs=None):
     root = Path(ncanda_root_dir)
     root_len = len(root.parts)
-    for path in root.rglob('*.nii.gz'):
+    paths = list(root.rglob('*.nii.gz'))
+    cache_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, 'ncanda_headers.jsonl')
+    headers = scan_image_headers([str(path) for path in paths], cache_path, jobs)
+
+    columns = {
+        'participant_id': [],
+        'series_type': [],
+        'overall_qa_assessment': [],
+        'file_path': [],
+        'exists': [],
+        'dimensions': [],
+        'lps': [],
+        'absent': [],
+    }
+    for path in paths:
         file_path = str(path)
-        participant_id = path.parts[root_len + 1]
-        series_type = path.parts[-1][0:-7]
-        qa = 3 if path.parts[root_len] == 'unusable' else 8
-        dimensions, lps = get_image_dimension(file_path, False)
-
-        df.loc[len(df.index)] = [
-            participant_id,
-            series_type,
-            qa,
-            file_path,
-            True,
-            dimensions,
-            lps,
-            -1,
-        ]
+        dimensions, lps = headers[file_path]
+        columns['participant_id'].append(path.parts[root_len + 1])
+        columns['series_type'].append(path.parts[-1][0:-7])
+        columns['overall_qa_assessment'].append(3 if path.parts[root_len] == 'unusable' else 8)
+        columns['file_path'].append(file_path)
+        columns['exists'].append(True)
+        columns['dimensions'].append(dimensions)
+        columns['lps'].append(lps)
+        columns['absent'].append(-1)
+    df = pd.DataFrame(columns)
 
     logger.info(f'Found {df.shape[0]} files.')
     return df
@@ -216,14 +278,14 @@ class CombinedLoss(torch.nn.Module):
 
         for i in range(self.presence_count):
             i_target = target[..., i + regression_count]
-            if i_target != -1:
-                i_output = output[..., i + regression_count]
-                # make them required dimension (1D -> 2D)
-                i_output2 = i_output.unsqueeze(0)
-                i_target2 = i_target.unsqueeze(0)
-                raw_loss = self.focal_loss(i_output2, i_target2)
-                loss += raw_loss / self.binary_class_weights[int(i_target), i]
+            i_output = output[..., i + regression_count]
             # if target is -1 then ignore difference because ground truth was missing
+            present = (i_target != -1).nonzero().flatten().tolist()
+            for j in present:
+                # make them required dimension (0D -> 2D)
+                raw_loss = self.focal_loss(i_output[j].reshape(1, 1), i_target[j].reshape(1, 1))
+                weight = self.binary_class_weights[int(i_target[j]), i]
+                loss += raw_loss / weight / len(present)
 
         return loss
 
@@ -240,7 +302,7 @@ def convert_bool_to_int(value: bool):
 class CustomGhosting(torchio.transforms.RandomGhosting):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -263,7 +325,7 @@ class CustomGhosting(torchio.transforms.RandomGhosting):
 class CustomMotion(torchio.transforms.RandomMotion):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -288,7 +350,7 @@ class CustomMotion(torchio.transforms.RandomMotion):
 class CustomBiasField(torchio.transforms.RandomBiasField):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -311,7 +373,7 @@ class CustomBiasField(torchio.transforms.RandomBiasField):
 class CustomSpike(torchio.transforms.RandomSpike):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -334,7 +396,7 @@ class CustomSpike(torchio.transforms.RandomSpike):
 class CustomGamma(torchio.transforms.RandomGamma):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -354,7 +416,7 @@ class CustomGamma(torchio.transforms.RandomGamma):
 class CustomNoise(torchio.transforms.RandomNoise):
     def apply_transform(self, subject: torchio.Subject) -> torchio.Subject:
         original_quality = subject['info'][0]
-        if original_quality < 6 and len(subject.applied_transforms) == 1:  # low quality image
+        if original_quality < 6 and len(subject.applied_transforms) == 0:  # low quality image
             return subject
         else:  # high-quality image, corrupt it
             transformed_subject = super().apply_transform(subject)
@@ -440,7 +502,104 @@ class CustomReorient(
         return transformed_subject
 
 
-def create_train_and_test_data_loaders(df, count_train):
+class PreprocessedVolumeCache:
+    """
+    Training volumes which are decoded, reoriented and rescaled once, instead of every epoch.
+
+    Volumes are preprocessed like ReorientAndRescale does during inference, and stored as
+    uncompressed .npy files, which later epochs memory map. Entries are keyed by the path and
+    modification time of the image, so modified images are preprocessed again. Without a
+    directory, nothing is stored and volumes are preprocessed on every read.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.preprocess = ReorientAndRescale(out_min_max=(0, 1))
+
+    def entry_name(self, image_path):
+        key = f'{Path(image_path).resolve()}:{os.stat(image_path).st_mtime_ns}'
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def read(self, image_path):
+        if self.directory is None:
+            return self.preprocess_image(image_path)
+
+        name = self.entry_name(image_path)
+        data_path = self.directory / f'{name}.npy'
+        affine_path = self.directory / f'{name}.affine.npy'
+        if data_path.exists():
+            # copy-on-write, so that augmentations may modify the tensor in place
+            return torch.from_numpy(np.load(data_path, mmap_mode='c')), np.load(affine_path)
+
+        data, affine = self.preprocess_image(image_path)
+        # the data file is written last, and atomically, since it marks a complete entry; data
+        # loader workers may write the same entry concurrently
+        np.save(affine_path, affine)
+        partial_path = self.directory / f'{name}.{os.getpid()}.partial'
+        with open(partial_path, 'wb') as fd:
+            np.save(fd, data.numpy())
+        os.replace(partial_path, data_path)
+        return data, affine
+
+    def preprocess_image(self, image_path):
+        subject = self.preprocess(torchio.Subject({'img': torchio.ScalarImage(image_path)}))
+        return subject['img'].data, subject['img'].affine
+
+
+class ShapeBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of images which have the same shape after preprocessing.
+
+    Images are grouped by their header, like plan_batches does for inference, and each group
+    is split into batches of at most batch_size images. TiledClassifier averages over tiles,
+    so padding would change the results; this way, only images whose axes were permuted by
+    the random reorientation need to be padded by pad_collate.
+    """
+
+    def __init__(self, image_paths, batch_size, shuffle=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        buckets = {}
+        for index, image_path in enumerate(image_paths):
+            # images without a readable header are batched on their own
+            key = read_image_header(image_path) if batch_size > 1 else None
+            buckets.setdefault(key or index, []).append(index)
+        self.buckets = list(buckets.values())
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = random.sample(bucket, len(bucket))
+            batches += [
+                bucket[start : start + self.batch_size]
+                for start in range(0, len(bucket), self.batch_size)
+            ]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return sum(math.ceil(len(bucket) / self.batch_size) for bucket in self.buckets)
+
+
+def pad_collate(subjects):
+    """Collate a batch, zero padding images whose axes were permuted by CustomReorient."""
+    shape = np.max([subject['img'].shape[1:] for subject in subjects], axis=0)
+    for subject in subjects:
+        padding = shape - np.array(subject['img'].shape[1:])
+        if padding.any():
+            # pad takes the padding of the last axis first
+            padding = [
+                int(size) for axis_padding in reversed(padding) for size in (0, axis_padding)
+            ]
+            subject['img'].set_data(torch.nn.functional.pad(subject['img'].data, padding))
+    return torch.utils.data.default_collate(subjects)
+
+
+def create_train_and_test_data_loaders(df, count_train, cache_dir=None, batch_size=1):
     images = []
     regression_targets = []
     sizes = {}
@@ -477,12 +636,14 @@ def create_train_and_test_data_loaders(df, count_train):
 
     ground_truth = np.asarray(regression_targets)
     count_val = df.shape[0] - count_train
+    # images are read already reoriented and rescaled to [0, 1]
+    cache = PreprocessedVolumeCache(cache_dir)
     train_files = [
-        torchio.Subject({'img': torchio.ScalarImage(img), 'info': info})
+        torchio.Subject({'img': torchio.ScalarImage(img, reader=cache.read), 'info': info})
         for img, info in zip(images[:count_train], ground_truth[:count_train])
     ]
     val_files = [
-        torchio.Subject({'img': torchio.ScalarImage(img), 'info': info})
+        torchio.Subject({'img': torchio.ScalarImage(img, reader=cache.read), 'info': info})
         for img, info in zip(images[-count_val:], ground_truth[-count_val:])
     ]
 
@@ -511,7 +672,6 @@ def create_train_and_test_data_loaders(df, count_train):
     logger.info(f'weights_array: {weights_array}')
     class_weights = torch.tensor(weights_array, dtype=torch.float).to(device)
 
-    rescale = torchio.transforms.RescaleIntensity(out_min_max=(0, 1))
     # axis_flip = torchio.transforms.RandomFlip(p=0.5, axes=(0, 1, 2))
     axis_orient = CustomReorient(p=0.5)
     ghosting = CustomGhosting(p=0.3, intensity=(0.2, 0.8))
@@ -521,9 +681,7 @@ def create_train_and_test_data_loaders(df, count_train):
     # gamma = CustomGamma(p=0.1)  # after quick experimentation: gamma does not appear to help
     noise = CustomNoise(p=0.1)
 
-    transforms = torchio.Compose(
-        [rescale, axis_orient, ghosting, motion, inhomogeneity, spike, noise]
-    )
+    transforms = torchio.Compose([axis_orient, ghosting, motion, inhomogeneity, spike, noise])
 
     # create a training data loader
     train_loader = None
@@ -531,8 +689,8 @@ def create_train_and_test_data_loaders(df, count_train):
         train_ds = torchio.SubjectsDataset(train_files, transform=transforms)
         train_loader = DataLoader(
             train_ds,
-            batch_size=1,
-            shuffle=True,
+            batch_sampler=ShapeBucketBatchSampler(images[:count_train], batch_size, shuffle=True),
+            collate_fn=pad_collate,
             num_workers=4,
             pin_memory=torch.cuda.is_available(),
         )
@@ -540,17 +698,29 @@ def create_train_and_test_data_loaders(df, count_train):
     # create a validation data loader
     val_loader = None
     if count_val > 0:
-        val_ds = torchio.SubjectsDataset(val_files, transform=rescale)
+        val_ds = torchio.SubjectsDataset(val_files)
         val_loader = DataLoader(
-            val_ds, batch_size=1, num_workers=4, pin_memory=torch.cuda.is_available()
+            val_ds,
+            batch_sampler=ShapeBucketBatchSampler(images[-count_val:], batch_size),
+            num_workers=4,
+            pin_memory=torch.cuda.is_available(),
         )
 
     return train_loader, val_loader, class_weights, sizes
 
 
-def train_and_save_model(df, count_train, save_path, num_epochs, val_interval, only_evaluate):
+def train_and_save_model(
+    df,
+    count_train,
+    save_path,
+    num_epochs,
+    val_interval,
+    only_evaluate,
+    cache_dir=None,
+    batch_size=1,
+):
     train_loader, val_loader, class_weights, sizes = create_train_and_test_data_loaders(
-        df, count_train
+        df, count_train, cache_dir, batch_size
     )
 
     pretrained_path = os.path.join(os.getcwd(), 'pretrained.pth')
@@ -576,11 +746,12 @@ def train_and_save_model(df, count_train, save_path, num_epochs, val_interval, o
 
     if only_evaluate:
         logger.info('Evaluating NN model on validation data')
-        evaluate_model(model, val_loader, device, writer, 0, 'val')
+        metrics = {'val_R2': evaluate_model(model, val_loader, device, writer, 0, 'val')}
         if train_loader is not None:
             logger.info('Evaluating NN model on training data')
-            evaluate_model(model, train_loader, device, writer, 0, 'train')
-        return sizes
+            metrics['train_R2'] = evaluate_model(model, train_loader, device, writer, 0, 'train')
+        writer.close()
+        return sizes, metrics
 
     _, file_name = os.path.split(save_path)
 
@@ -590,7 +761,7 @@ def train_and_save_model(df, count_train, save_path, num_epochs, val_interval, o
         model.train()
         epoch_loss = 0.0
         step = 0
-        epoch_len = len(train_loader.dataset) // train_loader.batch_size
+        epoch_len = len(train_loader)
         logger.info(f'epoch_len: {epoch_len}')
         y_true = []
         y_pred = []
@@ -655,10 +826,18 @@ def train_and_save_model(df, count_train, save_path, num_epochs, val_interval, o
 
     logger.info(f'train completed, best_metric: {best_metric:.2f} at epoch: {best_metric_epoch}')
     writer.close()
-    return sizes
+    return sizes, {'best_val_R2': best_metric, 'best_epoch': best_metric_epoch}
 
 
-def process_folds(folds_prefix, validation_fold, evaluate_only, fold_count):
+def process_folds(
+    folds_prefix,
+    validation_fold,
+    evaluate_only,
+    fold_count,
+    cache_dir=None,
+    batch_size=1,
+    run_group=None,
+):
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
     folds = []
@@ -686,19 +865,80 @@ def process_folds(folds_prefix, validation_fold, evaluate_only, fold_count):
     epoch_count = max(35, int(30000 / df.shape[0]))
     epoch_count = math.ceil(epoch_count / val_count) * val_count
 
-    wandb.init(project='miqaMix', sync_tensorboard=True)
+    # each fold gets its own run, and thereby its own TensorBoard log directory
+    wandb.init(
+        project='miqaMix',
+        sync_tensorboard=True,
+        group=run_group,
+        name=f'{"evaluate" if evaluate_only else "train"}-val{validation_fold}',
+        reinit=True,
+    )
     count_train = df.shape[0] - vf.shape[0]
     model_path = os.getcwd() + f'/models/miqaMix-val{validation_fold}.pth'
-    sizes = train_and_save_model(
+    sizes, metrics = train_and_save_model(
         df,
         count_train,
         save_path=model_path,
         num_epochs=epoch_count,
         val_interval=val_count,
         only_evaluate=evaluate_only,
+        cache_dir=cache_dir,
+        batch_size=batch_size,
     )
 
     logger.info('Image size distribution:\n' + str(sizes))
+    wandb.finish()
+    return metrics
+
+
+def process_all_folds(folds_prefix, fold_count, jobs=1, threads=None, cache_dir=None, batch_size=1):
+    """
+    Train a model for each fold, then evaluate each of them, and summarize the fold metrics.
+
+    Up to jobs folds are processed at the same time, each in its own process, which gets an
+    equal share of the cores unless threads per process are given.
+    """
+    run_group = datetime.now().strftime('folds-%Y%m%d-%H%M%S')
+
+    def process(evaluate_only):
+        process_fold = partial(
+            process_folds,
+            folds_prefix,
+            evaluate_only=evaluate_only,
+            fold_count=fold_count,
+            cache_dir=cache_dir,
+            batch_size=batch_size,
+            run_group=run_group,
+        )
+        if jobs == 1:
+            return [process_fold(f) for f in range(fold_count)]
+        # spawn, since neither torch nor wandb is safe to fork once used
+        with ProcessPoolExecutor(
+            jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_worker,
+            initargs=(jobs, 0, threads),
+        ) as executor:
+            return list(executor.map(process_fold, range(fold_count)))
+
+    logger.info(f'Training {fold_count} folds, {jobs} at a time')
+    training_metrics = process(False)
+    evaluation_metrics = process(True)
+
+    summary = pd.DataFrame(
+        [
+            {**trained, **evaluated}
+            for trained, evaluated in zip(training_metrics, evaluation_metrics)
+        ]
+    )
+    summary = pd.concat([summary, summary.agg(['mean', 'std'])])
+    summary.index.name = 'validation_fold'
+    # evaluation results are printed at the end, so they are easy to pick up from the log
+    print(f'Cross-validation summary:\n{summary}')
+    full_path = Path(f'{run_group}-summary.csv').absolute()
+    summary.to_csv(full_path)
+    logger.info(f'CSV file written: {full_path}')
+    return summary
 
 
 if __name__ == '__main__':
@@ -722,9 +962,32 @@ if __name__ == '__main__':
     # add bool for full cross-validation
     parser.add_argument('--all', dest='all', action='store_true')
     parser.set_defaults(all=False)
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        help='Parallel processes for --all (default: 1) and --ncanda (default: one per core)',
+        type=int,
+    )
+    parser.add_argument(
+        '--threads',
+        help='Torch threads per parallel fold (default: an equal share of the cores)',
+        type=int,
+    )
     # add option to evaluate on just one image
     parser.add_argument('--evaluate1', '-1', help='Path to an image to evaluate', type=str)
     parser.add_argument('--modelfile', '-m', help='Path to neural network model weights', type=str)
+    parser.add_argument(
+        '--cache',
+        help='Directory where preprocessed training images and scanned image headers are kept',
+        type=str,
+    )
+    parser.add_argument(
+        '--batch-size',
+        '-b',
+        help='Images per batch; only images with the same dimensions are batched together',
+        type=int,
+        default=1,
+    )
 
     args = parser.parse_args()
     logger.info(args)
@@ -732,14 +995,13 @@ if __name__ == '__main__':
     monai.config.print_config()
 
     if args.all:
-        logger.info(f'Training {args.nfolds} folds')
-        for f in range(args.nfolds):
-            process_folds(args.folds, f, False, args.nfolds)
-        # evaluate all at the end, so results are easy to pick up from the log
-        for f in range(args.nfolds):
-            process_folds(args.folds, f, True, args.nfolds)
+        process_all_folds(
+            args.folds, args.nfolds, args.jobs or 1, args.threads, args.cache, args.batch_size
+        )
     elif args.folds is not None:
-        process_folds(args.folds, args.vfold, args.evaluate, args.nfolds)
+        process_folds(
+            args.folds, args.vfold, args.evaluate, args.nfolds, args.cache, args.batch_size
+        )
     elif args.modelfile is not None and args.evaluate1 is not None:
         evaluate1(get_model(args.modelfile), args.evaluate1)
     elif args.predicthd is not None:
@@ -753,7 +1015,7 @@ if __name__ == '__main__':
         logger.info(f'CSV file written: {full_path}')
     elif args.ncanda is not None:
         args.ncanda
-        df = ncanda_construct_data_frame(args.ncanda)
+        df = ncanda_construct_data_frame(args.ncanda, args.cache, args.jobs)
         logger.info(f'\n{df}')
         full_path = Path('ncanda0.csv').absolute()
         df.to_csv(full_path, index=False)
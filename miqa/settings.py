@@ -17,6 +17,7 @@ from composed_configuration import (
 )
 from composed_configuration._configuration import _BaseConfiguration
 from configurations import values
+from kombu import Queue
 
 
 class MiqaMixin(ConfigMixin):
@@ -43,6 +44,65 @@ class MiqaMixin(ConfigMixin):
     # Enable the following to replace null creation times for scan decisions with import time
     REPLACE_NULL_CREATION_DATETIMES = values.BooleanValue(environ=True, default=False)
 
+    # Each worker process keeps recently used evaluation models loaded, up to these limits
+    MODEL_CACHE_SIZE = values.PositiveIntegerValue(environ=True, default=4)
+    MODEL_CACHE_MAX_MEGABYTES = values.PositiveIntegerValue(environ=True, default=1024)
+    # Number of 64^3 tiles run through the network in one forward pass (0 for all tiles at once)
+    INFERENCE_TILE_BATCH_SIZE = values.PositiveIntegerValue(environ=True, default=8)
+    # Number of volumes with the same dimensions evaluated in one batch by evaluate_data
+    INFERENCE_BATCH_SIZE = values.PositiveIntegerValue(environ=True, default=1)
+    # With ZARR_SUPPORT, local frames are read from this level of their Zarr pyramid instead of
+    # the NIfTI file (0 is full resolution, higher levels give a faster but rougher screening)
+    INFERENCE_PYRAMID_LEVEL = values.IntegerValue(environ=True, default=None)
+    # Torch threads of each worker process; by default the cores are split evenly between the
+    # worker processes, instead of every process using all of them
+    INFERENCE_THREADS = values.PositiveIntegerValue(environ=True, default=None)
+    INFERENCE_INTEROP_THREADS = values.PositiveIntegerValue(environ=True, default=1)
+    # Pin each worker process to the cores its threads run on
+    INFERENCE_PIN_WORKERS = values.BooleanValue(environ=True, default=False)
+    # Device used for inference, e.g. "cpu" or "cuda" (default: a GPU if there is one); with
+    # several GPUs, "cuda" spreads the worker processes over all of them
+    INFERENCE_DEVICE = values.Value(environ=True, default=None)
+    # Number of S3 files downloaded in parallel while a batch of frames is evaluated
+    S3_DOWNLOAD_WORKERS = values.PositiveIntegerValue(environ=True, default=4)
+    # Size of the connection pool of each shared S3 client
+    S3_MAX_POOL_CONNECTIONS = values.PositiveIntegerValue(environ=True, default=32)
+    # Lifetime of presigned frame download URLs, and how long they are reused for (seconds);
+    # URLs are reused for at most 3/4 of their lifetime
+    S3_PRESIGNED_URL_EXPIRATION = values.PositiveIntegerValue(environ=True, default=3600)
+    S3_PRESIGNED_URL_CACHE_TIMEOUT = values.PositiveIntegerValue(environ=True, default=2700)
+
+    # Imported frames are evaluated by parallel tasks, each of which evaluates this many frames
+    EVALUATION_CHUNK_SIZE = values.PositiveIntegerValue(environ=True, default=100)
+    # Uploaded frames are evaluated in batches of up to this many frames, which are collected
+    # for at most this many seconds
+    EVALUATION_BATCH_SIZE = values.PositiveIntegerValue(environ=True, default=16)
+    EVALUATION_BATCH_WINDOW = values.PositiveIntegerValue(environ=True, default=5)
+
+    # Directory where workers write per-stage inference metrics, for the textfile collector of
+    # the Prometheus node exporter (durations are also logged after each evaluation task)
+    INFERENCE_METRICS_DIR = values.Value(environ=True, default=None)
+
+    # Inference, Zarr conversion and import/export tasks have their own queues, so that
+    # dedicated workers can be scaled independently (e.g. "celery worker -Q inference"). A
+    # worker started without -Q consumes all of them. Within the inference queue, evaluations
+    # of uploaded frames take priority over the evaluation of large imports.
+    CELERY_TASK_QUEUES = [
+        Queue('celery'),
+        Queue('inference', queue_arguments={'x-max-priority': 10}),
+        Queue('conversion'),
+        Queue('io'),
+    ]
+    CELERY_TASK_ROUTES = {
+        'miqa.core.tasks.evaluate_frame_content': {'queue': 'inference', 'priority': 9},
+        'miqa.core.tasks.evaluate_pending_frames': {'queue': 'inference', 'priority': 9},
+        'miqa.core.tasks.evaluate_chunk': {'queue': 'inference', 'priority': 3},
+        'miqa.core.tasks.evaluate_data': {'queue': 'inference', 'priority': 3},
+        'miqa.core.conversion.nifti_to_zarr_ngff.nifti_to_zarr_ngff': {'queue': 'conversion'},
+        'miqa.core.tasks.perform_import': {'queue': 'io'},
+        'miqa.core.tasks.perform_export': {'queue': 'io'},
+    }
+
     # Override default signup sheet to ask new users for first and last name
     ACCOUNT_FORMS = {'signup': 'miqa.core.rest.accounts.AccountSignupForm'}
 
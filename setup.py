@@ -73,11 +73,16 @@ setup(
         'learning': [
             'itk>=5.3rc4',
             'monai',
+            'nibabel',
             'scikit-learn',
             'torch',
             'torchio',
             'wandb',
         ],
+        'onnx': [
+            'onnx',
+            'onnxruntime',
+        ],
         'zarr': [
             'itk-io',
             'itk-filtering',